@@ -1,134 +1,578 @@
 #!/usr/bin/python3
 
 import os
-import pprint
 import sys
+import io
 import re
+import string
 import decimal
 import qifparser
 import datetime
 import logging
 import math
+import argparse
+import pickle
+import hashlib
+import atexit
+import json
+import collections
+import bisect
+import heapq
+import itertools
+import contextlib
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+#:
 
 cents = decimal.Decimal('0.01')
+ZERO = decimal.Decimal()
+
+# buffer size of the Beancount and trace files
+OUTPUT_BUFFER = 1 << 20
+
+# the posting stages of Metrics, by Transaction.priority()
+POST_STAGES = ("post:invst", "post:splits", "post:other")
+
+# quantize exponents by number of decimals
+exponents = {}
+
+class Tracer(object):
+    """ structured trace events, off unless enabled per subsystem
+
+    Each subsystem is an attribute that is False while it is off, and call
+    sites test it before building an event, so that a disabled trace costs
+    one attribute lookup:
+
+        if session.trace.lots:
+            session.trace.event("lots", "add", account=self.name, quantity=quantity)
 
-def get_beancount_name(q_name, q_acct_type=None):
-
-    tt = {"_OpeningBalances": "Equity:Opening-Balances",
-          "_Commissions": "Expenses:Investment-Commissions",
-          "_IntInc": "Income:Investments:Interest",
-          "_DivInc": "Income:Investments:Dividends",
-          "_ShrsInOut": "Equity:Share-Transfers",
-          "_Exchange": "Expenses:Currency-Exchange",
-          "_Accrued Int": "Income:Investments:Accruals",
-          "House": "Assets:House",
-          "Bonus": "Income:Salary:Bonus",
-          "Consulting Inc": "Income:Consulting",
-          "Bank-Interest": "Income:Bank-Interest",
-          "Int Inc": "Income:Bank-Interest",
-          "Loan Payment": "Liabilities:Bank-Loans",
-          "Rental Income": "Income:Condo",
-          "_ST CapGnDst": "Income:Investments:Capital-Gains",
-          "_IntExp": "Expenses:Bank-Loan-Interest",
-          "_RlzdGains": "Income:Investments:Realized-Gains",
-          }
-
-    if q_name in tt:
-        return tt[q_name]
+    Events are written as JSON lines.  With accounts set only the events
+    about those accounts (or about no account in particular) are written.
+    """
+
+    subsystems = ("post", "lots", "prices", "transfers", "emit")
+
+    def __init__(self):
+        for subsystem in self.subsystems:
+            setattr(self, subsystem, False)
+        #:
+        self.fh = None
+        self.accounts = None
     #:
-    
-    s = q_name
-    s = re.sub(' ', '-', s)
-    s = re.sub('[^A-Za-z0-9\-:]', '', s)
-    s = re.sub('\-+', '-', s)
-    
-    parts = s.split(":")
-    for i in range(len(parts)):
-        parts[i] = parts[i][0].upper() + parts[i][1:]
+
+    def enable(self, subsystems, fh, accounts=None):
+        for subsystem in subsystems:
+            setattr(self, subsystem, True)
+        #:
+        self.fh = fh
+        self.accounts = set(accounts) if accounts else None
     #:
-    s = ":".join(parts)
 
-    clean_name = s
-    
-    if "Opening Balance" in q_name:
-        return f"Equity:Opening-Balance:{clean_name}"
+    def event(self, subsystem, event, **fields):
+        if self.accounts is not None:
+            names = [fields[field] for field in ("account", "to_account") if field in fields]
+            if names and not self.accounts.intersection(names):
+                return
+            #:
+        #:
+        fields = dict(subsystem=subsystem, event=event, **fields)
+        self.fh.write(json.dumps(fields, default=str) + "\n")
     #:
-          
-    if q_acct_type in ["CCard", "Oth L", "Bill", "Tax"]:
-        return f"Liabilities:{clean_name}"
+#:
+
+def peak_rss_kb():
+    """ the peak resident memory of the process so far in kB, None where the platform does not tell """
+
+    if resource is None:
+        return None
     #:
-        
-    if q_acct_type in ["Bank", "Cash", "Oth A", "Port", "Invoice", "RRSP", "Mutual"]:
-        return f"Assets:{clean_name}"
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return peak // 1024 if sys.platform == "darwin" else peak
+#:
+
+class Metrics(object):
+    """ wall and CPU time of each stage of a conversion, and event counters
+
+        with session.metrics.stage("emit"):
+            ...
+        session.metrics.count("transfers.matched")
+
+    The time of a stage leaves out the stages run inside it, and adds up
+    over every time the stage is run.  Every stage also records how much
+    it raised the peak memory of the process, stages run inside it
+    included (rss_increase_kb), where the platform tells: memory reused
+    from an earlier stage does not count.  Histograms count how often each
+    value was observed.
+
+    Timing each record parsed and each transaction posted costs about a
+    tenth of the run, so it is only done when fine is set; otherwise
+    parse is counted as part of accounts and posting as post.
+    """
+
+    def __init__(self, fine=False):
+        self.fine = fine
+        self.stages = {}
+        self.counters = collections.Counter()
+        self.histograms = {}
+        # [stage, wall start, CPU start, wall of nested stages, CPU of nested stages, peak memory at start]
+        self.running = []
     #:
 
-    if q_acct_type == "Income":
-        return f"Income:{clean_name}"
+    def start(self, name):
+        self.running.append([name, time.perf_counter(), time.process_time(), 0.0, 0.0, peak_rss_kb()])
     #:
-        
-    if q_acct_type == "Expenses":
-        return f"Expenses:{clean_name}"
+
+    def stop(self):
+        name, wall, cpu, nested_wall, nested_cpu, peak = self.running.pop()
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        if self.running:
+            self.running[-1][3] += wall
+            self.running[-1][4] += cpu
+        #:
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = {"wall": 0.0, "cpu": 0.0}
+        #:
+        stage["wall"] += wall - nested_wall
+        stage["cpu"] += cpu - nested_cpu
+        if peak is not None:
+            stage["rss_increase_kb"] = stage.get("rss_increase_kb", 0) + peak_rss_kb() - peak
+        #:
+    #:
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop()
+        #:
+    #:
+
+    def timed(self, name, iterable):
+        """ the items of iterable, the time taken to produce them counted as stage name if fine """
+
+        if not self.fine:
+            yield from iterable
+            return
+        #:
+        iterator = iter(iterable)
+        end = object()
+        while True:
+            self.start(name)
+            try:
+                item = next(iterator, end)
+            finally:
+                self.stop()
+            #:
+            if item is end:
+                return
+            #:
+            yield item
+        #:
+    #:
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+    #:
+
+    def observe(self, name, value):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = collections.Counter()
+        #:
+        histogram[value] += 1
+    #:
+
+    def report(self):
+        """ everything recorded, as JSON-ready dicts """
+        return {"stages": self.stages,
+                "counters": dict(sorted(self.counters.items())),
+                "histograms": {name: {str(value): count for value, count in sorted(histogram.items())}
+                               for name, histogram in sorted(self.histograms.items())}}
     #:
-        
-    raise ValueError(f"Can't translate Quicken name: {q_name} {q_acct_type}")
 #:
 
-class Account(object):
+class Mapping(object):
+    """ Quicken account, category, security and currency names to Beancount's
+
+    The rules are compiled once and each account name is only translated
+    once per (name, type).  A JSON file given to load() adds to the
+    built-in rules (Mapping.defaults):
+
+        {"names": {"House": "Assets:House"},
+         "rules": [{"prefix": "Loan ", "name": "Liabilities:Loans:{clean}"},
+                   {"pattern": "^(?P<bank>\\w+) Visa$", "types": ["CCard"], "name": "Liabilities:{bank}:Visa"}],
+         "types": {"Brokerage": "Assets"},
+         "securities": {"Big Fund Series A": "BFA"},
+         "currency": "CAD",
+         "currencies": {"US$": "USD"}}
+
+    names maps exact Quicken names.  The rules are tried in order, those
+    of the file first: a rule matches the names that start with prefix or
+    contain pattern, only of the Quicken account types listed if types is
+    given, and gives name formatted with clean (the Quicken name cleaned
+    up), q_name, type and the named groups of pattern, which cannot have
+    those three names.  Other names go under the top level account types
+    gives for their Quicken type (Income and Expenses for categories).
+    securities maps exact Quicken security names.  Accounts are in
+    currency unless their description has a <TAG>, which currencies maps
+    to a currency (a tag missing there being the currency itself).
+    """
+
+    defaults = {
+        "names": {"_OpeningBalances": "Equity:Opening-Balances",
+                  "_Commissions": "Expenses:Investment-Commissions",
+                  "_IntInc": "Income:Investments:Interest",
+                  "_DivInc": "Income:Investments:Dividends",
+                  "_ShrsInOut": "Equity:Share-Transfers",
+                  "_Exchange": "Expenses:Currency-Exchange",
+                  "_Accrued Int": "Income:Investments:Accruals",
+                  "House": "Assets:House",
+                  "Bonus": "Income:Salary:Bonus",
+                  "Consulting Inc": "Income:Consulting",
+                  "Bank-Interest": "Income:Bank-Interest",
+                  "Int Inc": "Income:Bank-Interest",
+                  "Loan Payment": "Liabilities:Bank-Loans",
+                  "Rental Income": "Income:Condo",
+                  "_ST CapGnDst": "Income:Investments:Capital-Gains",
+                  "_IntExp": "Expenses:Bank-Loan-Interest",
+                  "_RlzdGains": "Income:Investments:Realized-Gains"},
+        "rules": [{"pattern": "Opening Balance", "name": "Equity:Opening-Balance:{clean}"}],
+        "types": {"CCard": "Liabilities", "Oth L": "Liabilities", "Bill": "Liabilities", "Tax": "Liabilities",
+                  "Bank": "Assets", "Cash": "Assets", "Oth A": "Assets", "Port": "Assets", "Invoice": "Assets",
+                  "RRSP": "Assets", "Mutual": "Assets",
+                  "Income": "Income", "Expenses": "Expenses"},
+        "securities": {},
+        "currency": "CAD",
+        "currencies": {"USD": "USD"},
+    }
+
+    _currency_tag = re.compile("<(.*?)>")
+    _invalid = re.compile(r"[^A-Za-z0-9\-:]")
+    _dashes = re.compile(r"-+")
+
+    def __init__(self, config=None):
+
+        config = config or {}
+        unknown = set(config) - set(self.defaults)
+        if unknown:
+            raise ValueError(f"Unknown mapping keys: {', '.join(sorted(unknown))}")
+        #:
+        defaults = self.defaults
+
+        self.names = dict(defaults["names"], **config.get("names", {}))
+        self.types = dict(defaults["types"], **config.get("types", {}))
+        self.securities = dict(defaults["securities"], **config.get("securities", {}))
+        self.currency = config.get("currency", defaults["currency"])
+        self.currencies = dict(defaults["currencies"], **config.get("currencies", {}))
+        self.rules = [self.compile(rule) for rule in config.get("rules", []) + defaults["rules"]]
+
+        # any change of the rules invalidates --state
+        self.digest = hashlib.blake2b(json.dumps(config, sort_keys=True).encode(), digest_size=16).hexdigest()
+        self.memo = {}
+    #:
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as fh:
+            return cls(json.load(fh))
+        #:
+    #:
+
+    @staticmethod
+    def compile(rule):
+        """ (compiled pattern, types or None, name) of a rule """
+
+        if "prefix" in rule:
+            pattern = re.compile("^" + re.escape(rule["prefix"]))
+        elif "pattern" in rule:
+            pattern = re.compile(rule["pattern"])
+        else:
+            raise ValueError(f"Mapping rule without prefix or pattern: {rule}")
+        #:
+        keywords = {"clean", "q_name", "type"}
+        reserved = set(pattern.groupindex) & keywords
+        if reserved:
+            raise ValueError(f"Mapping rule using reserved group names ({', '.join(sorted(reserved))}): {rule}")
+        #:
+        fields = {re.split(r"[.\[]", field)[0] for _, field, _, _ in string.Formatter().parse(rule["name"])
+                  if field is not None}
+        # "{}" and "{0}" have no value to take either
+        unknown = [field or "{}" for field in sorted(fields - set(pattern.groupindex) - keywords)]
+        if unknown:
+            raise ValueError(f"Mapping rule name with unknown fields ({', '.join(unknown)}): {rule}")
+        #:
+        types = frozenset(rule["types"]) if "types" in rule else None
+        return pattern, types, rule["name"]
+    #:
+
+    def clean(self, q_name):
+        """ q_name with dashes for spaces, only letters, digits, dashes and colons, and capitalized parts """
+
+        name = self._dashes.sub("-", self._invalid.sub("", q_name.replace(" ", "-")))
+        return ":".join(part[:1].upper() + part[1:] for part in name.split(":"))
+    #:
+
+    def account_name(self, q_name, q_type=None):
+        """ the Beancount name of a Quicken account or category """
+
+        key = (q_name, q_type)
+        name = self.memo.get(key)
+        if name is None:
+            name = self.memo[key] = self.translate(q_name, q_type)
+        #:
+        return name
+    #:
+
+    def translate(self, q_name, q_type):
+
+        name = self.names.get(q_name)
+        if name is not None:
+            return name
+        #:
+
+        clean = self.clean(q_name)
+        for pattern, types, name in self.rules:
+            if types is not None and q_type not in types:
+                continue
+            #:
+            m = pattern.search(q_name)
+            if m:
+                return name.format(**m.groupdict(), clean=clean, q_name=q_name, type=q_type)
+            #:
+        #:
+
+        root = self.types.get(q_type)
+        if root:
+            return f"{root}:{clean}"
+        #:
+
+        raise ValueError(f"Can't translate Quicken name: {q_name} {q_type}")
+    #:
+
+    def security_name(self, q_name):
+        """ the Beancount commodity of a Quicken security: upper case, at most 24 characters """
+
+        name = self.securities.get(q_name)
+        if name is None:
+            name = self._dashes.sub("-", self._invalid.sub("", q_name.upper().replace(" ", "-")))
+            name = name[:24].rstrip("-")
+        #:
+        return name
+    #:
+
+    def account_currency(self, description):
+        """ the currency of an account with that description """
+
+        m = self._currency_tag.search(description or "")
+        if not m:
+            return self.currency
+        #:
+        return self.currencies.get(m.group(1), m.group(1))
+    #:
+
+    def all_currencies(self):
+        """ the default currency and those tags map to """
+        return list(dict.fromkeys([self.currency] + list(self.currencies.values())))
+    #:
+#:
+
+class Lots(object):
+    """ the lots of one security held in an account, in booking order
+
+    Lots are dicts with security, date, quantity and cost (a per-unit
+    Amount, None when unknown).  The total quantity and the total cost of
+    the lots with a known cost are kept as lots come and go.
+
+    FIFO and LIFO keep the lots oldest first in a deque.  AVERAGE pools
+    the lots with a known cost into one lot at their average cost when a
+    sale needs it, ahead of the lots without a cost, which are kept apart
+    oldest first.  HIFO
+    keeps them in a heap on (-cost, sequence number), unknown costs last,
+    so that adding and removing a lot costs O(log n) and only in_order()
+    sorts them.
+    """
+
+    bookings = ("FIFO", "LIFO", "HIFO", "AVERAGE")
+
+    def __init__(self, booking="FIFO"):
+        self.booking = booking
+        self.lots = [] if booking == "HIFO" else collections.deque()
+        self.sequence = itertools.count()
+        self.quantity = decimal.Decimal()
+        self.cost = decimal.Decimal()
+        self.pooled = True
+    #:
+
+    def __len__(self):
+        return len(self.lots)
+    #:
+
+    def __iter__(self):
+        return iter(self.in_order())
+    #:
+
+    def __repr__(self):
+        return repr(self.in_order())
+    #:
+
+    def add(self, lot):
+        if self.booking == "HIFO":
+            rank = (0, -lot["cost"].quantity) if lot["cost"] else (1, 0)
+            heapq.heappush(self.lots, (rank, next(self.sequence), lot))
+        else:
+            self.lots.append(lot)
+        #:
+        self.quantity += lot["quantity"]
+        if lot["cost"]:
+            self.cost += lot["quantity"] * lot["cost"].quantity
+        #:
+        self.pooled = False
+    #:
+
+    def pool(self):
+        # AVERAGE pools the lots with a known cost into one at their average cost
+        if self.pooled:
+            return
+        #:
+        known = [lot for lot in self.lots if lot["cost"]]
+        unknown = [lot for lot in self.lots if not lot["cost"]]
+        quantity = sum(lot["quantity"] for lot in known)
+        if len(known) > 1 and quantity:
+            first = known[0]
+            known = [{
+                "security": first["security"],
+                "date": first["date"],
+                "quantity": quantity,
+                "cost": Amount(self.cost / quantity, first["cost"].security, prec=7)}]
+        #:
+        self.lots = collections.deque(known + unknown)
+        self.pooled = True
+    #:
+
+    def in_order(self):
+        """ the lots in the order they are removed """
+
+        if self.booking == "HIFO":
+            return [lot for rank, sequence, lot in sorted(self.lots)]
+        elif self.booking == "AVERAGE":
+            self.pool()
+        elif self.booking == "LIFO":
+            return list(reversed(self.lots))
+        #:
+        return list(self.lots)
+    #:
+
+    def first(self):
+        if self.booking == "HIFO":
+            return self.lots[0][2]
+        #:
+        return self.lots[-1] if self.booking == "LIFO" else self.lots[0]
+    #:
+
+    def pop(self):
+        if self.booking == "HIFO":
+            heapq.heappop(self.lots)
+        elif self.booking == "LIFO":
+            self.lots.pop()
+        else:
+            self.lots.popleft()
+        #:
+    #:
+
+    def remove(self, quantity):
+        """ (removed lots, quantity left over when the lots ran out) """
+
+        if self.booking == "AVERAGE":
+            self.pool()
+        #:
+        removals = []
+        while quantity > 0 and self.lots:
+            lot = self.first()
+            removal = dict(lot)
+            if lot["quantity"] <= quantity:
+                self.pop()
+            else:
+                lot["quantity"] -= quantity
+                removal["quantity"] = quantity
+            #:
+            quantity -= removal["quantity"]
+            self.quantity -= removal["quantity"]
+            if removal["cost"]:
+                self.cost -= removal["quantity"] * removal["cost"].quantity
+            #:
+            removals.append(removal)
+        #:
+        if not self.lots:
+            self.quantity = decimal.Decimal()
+            self.cost = decimal.Decimal()
+        #:
+        return removals, quantity
+    #:
+#:
 
-    names = {}
-    q_names = {}
+class Account(object):
     
-    def __init__(self, q_name=None, q_category=None, q_account=None, currency=None):
+    def __init__(self, session, q_name=None, q_category=None, q_account=None, currency=None):
 
+        self.session = session
         self.q = q_account
 
         if q_name:
-            self.name = get_beancount_name(q_name)
+            self.name = session.mapping.account_name(q_name)
             self.q_name = q_name
         elif q_category:
-            if category.income:
-                self.name = get_beancount_name(category.qname, "Income")
+            if q_category.income:
+                self.name = session.mapping.account_name(q_category.qname, "Income")
             else:
-                self.name = get_beancount_name(category.qname, "Expenses")
+                self.name = session.mapping.account_name(q_category.qname, "Expenses")
             #
             self.q_name = q_category.qname
         elif q_account:
-            self.name = get_beancount_name(q_account.qname, q_account.type)
+            self.name = session.mapping.account_name(q_account.qname, q_account.type)
             self.q_name = f"[{q_account.qname}]" 
         else:
             raise ValueError("Name not provided")
         #:
         
-        if self.q_name and self.q_name in Account.q_names:
+        if self.q_name and self.q_name in session.q_names:
             raise ValueError(f"Duplicate account q_name: {self.q_name}")
         #:
         
-        if self.name in Account.names:
+        if self.name in session.names:
             raise ValueError(f"Duplicate account name: {self.name}")
         #:
 
-        Account.names[self.name] = self
+        session.names[self.name] = self
         if self.q_name:
-            Account.q_names[self.q_name] = self
+            session.q_names[self.q_name] = self
         #:
 
-        self.currency = Security.dict["CAD"]
-        if currency:
-            self.currency = Security.dict[currency]
-        elif self.q and self.q.description:
-            m = re.search("<(.*?)>", self.q.description)
-            if m:
-                self.currency = Security.dict[m.group(1)]
-            #:
-        #:
+        # a currency tag missing from the mapping is created as it is met
+        currency = currency or session.mapping.account_currency(self.q and self.q.description)
+        self.currency = session.securities.get(currency) or Security(session, currency)
         
         self.firstdate = None
         self.lastdate = None
         self.holdings = {}
-        self.pending_transfers = []
+        # transfers waiting for the other side, by sequence number, and
+        # their (date, sequence number) sorted by date under transfer_keys()
+        self.pending_transfers = {}
+        self.pending_index = {}
         self.transactions = []
 
-        print(f"1901-01-01 open {self.name}")
+        # the posting column, padded for the amounts to line up
+        self.column = f"  {self.name:40}"
+
+        session.output.write(f"1901-01-01 open {self.name}\n")
 
         logging.debug(f"New account: {self.name} --> {self.q_name} {self.currency.name}")
     #:
@@ -139,50 +583,49 @@ class Account(object):
 
     def add_holding(self, security, date, quantity, cost):
 
-        logging.debug(f"Add holding: {security} {date} {quantity} {cost}")
+        if self.session.trace.lots:
+            self.session.trace.event("lots", "add", account=self.name, security=security.name, date=date, quantity=quantity, cost=cost)
+        #:
         
         if security == self.currency:
             return
         #:
         
         if security.name not in self.holdings:
-            self.holdings[security.name] = []
+            self.holdings[security.name] = Lots(self.session.booking)
         #:
     
-        self.holdings[security.name].append({
+        self.holdings[security.name].add({
             "security": security,
             "date": date,
             "quantity": quantity,
             "cost": cost})
-        #:
     #:
 
     def remove_holding(self, security, quantity_to_be_removed):
 
-        logging.debug(f"Remove: {quantity_to_be_removed} {security.name}")
-        logging.debug(f"Holdings: {pprint.pformat(self.holdings.get(security.name, []))}")
         removals = []
         remaining = quantity_to_be_removed
 
-        while remaining > 0 and security.name in self.holdings:
-            logging.debug(f"Remaining: {remaining}")
-            holding = self.holdings[security.name][0]
-            removal = dict(holding)
-            if holding["quantity"] <= remaining:
-                self.holdings[security.name].pop(0)
-                if not self.holdings[security.name]:
-                    del self.holdings[security.name]
-                #:
-            else:
-                holding["quantity"] -= remaining
-                removal["quantity"] = remaining
+        lots = self.holdings.get(security.name)
+        if self.session.trace.lots:
+            self.session.trace.event("lots", "remove", account=self.name, security=security.name, quantity=quantity_to_be_removed,
+                        lots=len(lots) if lots else 0, held=lots.quantity if lots else 0, cost=lots.cost if lots else 0)
+        #:
+        if lots is not None:
+            removals, remaining = lots.remove(remaining)
+            if not lots:
+                del self.holdings[security.name]
             #:
-            remaining -= removal["quantity"] 
-            removals.append(removal)
         #:
 
+        self.session.metrics.observe("lots.per_sell", len(removals))
+        self.session.metrics.count("lots.consumed", len(removals))
         if remaining > 0:
-            logging.debug(f"Shorted: {security} {remaining}")
+            self.session.metrics.count("lots.shorted")
+            if self.session.trace.lots:
+                self.session.trace.event("lots", "shorted", account=self.name, security=security.name, quantity=remaining)
+            #:
             removals.append({
                 "security": security,
                 "date": None,
@@ -190,10 +633,65 @@ class Account(object):
                 "cost": None})
         #:
 
-        logging.debug(f"Removed: {removals}")
+        if self.session.trace.lots:
+            self.session.trace.event("lots", "removed", account=self.name, security=security.name,
+                        lots=[(removal["date"], removal["quantity"], removal["cost"]) for removal in removals])
+        #:
         return removals
     #:
 
+    @staticmethod
+    def transfer_keys(to_account, amount):
+        # by amount for transfers in one currency, by account alone for
+        # transfers between currencies
+        return [(to_account.name, amount.quantity, amount.security.name), (to_account.name,)]
+    #:
+
+    def pend_transfer(self, transfer):
+
+        sequence = next(self.session.transfer_sequence)
+        self.pending_transfers[sequence] = transfer
+        for key in self.transfer_keys(transfer["to_account"], transfer["amount"]):
+            bisect.insort(self.pending_index.setdefault(key, []), (transfer["date"], sequence))
+        #:
+    #:
+
+    def match_transfer(self, from_account, date, amount):
+        """ (number of equally good matches, the pending transfer taken or None)
+
+        A pending transfer to from_account matches when it is dated within
+        transfer_window days of date and, unless the accounts are in
+        different currencies, is for -amount.  The closest date wins, then
+        the transfer pended last.
+        """
+
+        if from_account.currency != self.currency:
+            key = (from_account.name,)
+        else:
+            key = (from_account.name, -amount.quantity, amount.security.name)
+        #:
+        entries = self.pending_index.get(key)
+        if not entries:
+            return 0, None
+        #:
+
+        window = datetime.timedelta(days=self.session.transfer_window)
+        candidates = entries[bisect.bisect_left(entries, (date - window, -1)):
+                             bisect.bisect_right(entries, (date + window, math.inf))]
+        if not candidates:
+            return 0, None
+        #:
+        distance = min(abs(pended - date) for pended, sequence in candidates)
+        matches = [sequence for pended, sequence in candidates if abs(pended - date) == distance]
+
+        transfer = self.pending_transfers.pop(matches[-1])
+        for key in self.transfer_keys(transfer["to_account"], transfer["amount"]):
+            entries = self.pending_index[key]
+            del entries[bisect.bisect_left(entries, (transfer["date"], matches[-1]))]
+        #:
+        return len(matches), transfer
+    #:
+
     def close(self, as_of):
 
         if self.holdings:
@@ -201,36 +699,32 @@ class Account(object):
             return
         #:
 
-        print(f"{as_of.strftime('%Y-%m-%d')} close {self.name}")
+        self.session.output.write(f"{as_of.strftime('%Y-%m-%d')} close {self.name}\n")
         logging.debug(f"Closing account: {self.name} as of {as_of.strftime('%Y-%m-%d')}")
     #:
 #:        
 
 class Security(object):
-
-    dict = {}
     
-    def __init__(self, q_name):
+    def __init__(self, session, q_name):
 
+        self.session = session
         self.q_name = q_name
 
-        self.name = q_name.upper()
-        self.name = re.sub(' ', '-', self.name)
-        self.name = re.sub('[^A-Za-z0-9\-:]', '', self.name)
-        self.name = re.sub('\-+', '-', self.name)
-        self.name = self.name[:24]
-        while self.name[-1] == "-":
-            self.name = self.name[:-1]
-        #:
+        self.name = session.mapping.security_name(q_name)
 
         logging.debug(f"New security: {self.q_name} --> {self.name}")
         
-        if self.q_name in Security.dict:
+        if self.q_name in session.securities:
             raise ValueError(f"Duplicate security name: {self.q_name}")
         #:
 
-        Security.dict[self.q_name] = self
-        
+        session.securities[self.q_name] = self
+
+        # price history sorted by date, prices[i] being the price on dates[i]:
+        # an Amount when derived from a transaction, a Decimal in no
+        # particular currency when quoted in the .qif file
+        self.dates = []
         self.prices = []
     #:
 
@@ -239,49 +733,65 @@ class Security(object):
     #:
 
     def add_price(self, date, price):
-        self.prices.append({"date": date, "price": price})
+        # a later price for the same date takes precedence
+        if self.session.trace.prices:
+            self.session.trace.event("prices", "add", security=self.name, date=date, price=price)
+        #:
+        i = bisect.bisect_right(self.dates, date)
+        self.dates.insert(i, date)
+        self.prices.insert(i, price)
     #:
-        
-    def get_price(self, date):
 
-        logging.debug(f"Get price: {self} {date}")
-        logging.debug(f"Database: {self.prices}")
+    def load_prices(self, quotes):
+        """ add a list of (date, price) in one go """
+        entries = list(zip(self.dates, self.prices)) + quotes
+        entries.sort(key=lambda entry: entry[0])
+        self.dates = [date for date, price in entries]
+        self.prices = [price for date, price in entries]
+    #:
         
+    def get_price(self, date, currency):
+
+        if self.session.trace.prices:
+            self.session.trace.event("prices", "get", security=self.name, date=date, prices=len(self.prices))
+        #:
+
+        self.session.metrics.count("prices.lookups")
         if not self.prices:
+            self.session.metrics.count("prices.missing")
             logging.error(f"No prices available for {self}")
             return None
         #:
 
-        price = None
-        
-        for entry in self.prices:
-            if date < entry["date"]:
-                break
-            #:
-            price = entry["price"]
-        #:
-
-        if price is None:
+        i = bisect.bisect_right(self.dates, date)
+        if i == 0:
+            self.session.metrics.count("prices.post_facto")
             logging.error(f"Post-facto price for {self} {date}")
-            price = self.prices[0]["price"]
+            i = 1
         #:
 
+        price = self.prices[i - 1]
+        if not isinstance(price, Amount):
+            price = Amount(price, currency, prec=7)
+        #:
         return price
     #:
 #:
-    
-class Transaction():
 
-    count = 0
+class Transaction():
     
     def __init__(self, from_account, q_transaction):
 
-        logging.debug(f"Transaction: {from_account} {q_transaction}")
+        self.session = session = from_account.session
+        if session.trace.post:
+            session.trace.event("post", "transaction", account=from_account.name,
+                        record={name: getattr(q_transaction, name) for name in q_transaction.__slots__
+                                if name != "account" and getattr(q_transaction, name) not in (None, ())})
+        #:
         self.from_account = from_account
         self.q = q_transaction
 
-        Transaction.count += 1
-        self.id = Transaction.count
+        self.id = next(session.transaction_count)
 
         self.action = self.q.action
         self.date = self.q.date
@@ -290,13 +800,13 @@ class Transaction():
         self.type = self.q.qtype
 
         if self.q.category:
-            self.to_account = Account.q_names[self.q.category]
+            self.to_account = session.q_names[self.q.category]
         else:
             self.to_account = None
         #:
 
         if self.to_account == self.from_account:
-            self.from_account = Account.q_names["_OpeningBalances"]
+            self.from_account = session.q_names["_OpeningBalances"]
         #:
 
         self.amount = Amount(self.q.tAmount, self.from_account.currency)
@@ -305,13 +815,14 @@ class Transaction():
         for split in self.q.splits:
             if split.amount != decimal.Decimal('0'):
                 amount = Amount(split.amount, self.from_account.currency)
-                to_account = Account.q_names[split.category]
+                to_account = session.q_names[split.category]
                 self.splits.append({"amount": amount, "to_account": to_account, "memo": split.memo})
             #:
         #:
         
         self.posted = False
         self.postings = []
+        self.legs = []
 
         if self.q.qtype != "Invst":
             return
@@ -326,7 +837,7 @@ class Transaction():
             return
         #:
         
-        self.security = Security.dict[self.q.security]
+        self.security = session.securities[self.q.security]
 
         if not self.q.quantity:
             return
@@ -334,10 +845,19 @@ class Transaction():
 
         self.trade_amount = Amount(self.q.quantity, self.security, prec=7)
 
+        # without a price the trade is priced by Converter.load() from the price history
+        if self.q.price:
+            self.price_trade()
+        #:
+    #:
+
+    def price_trade(self):
+        """ set the trade price and amount, adding the price to the security's history """
+
         if self.q.price:
             self.trade_price = Amount(self.q.price, self.security, prec=7)
         else:
-            self.trade_price = self.security.get_price(self.date)
+            self.trade_price = self.security.get_price(self.date, self.from_account.currency)
             if self.trade_price is None:
                 self.trade_price = Amount(0, self.from_account.currency, prec=7)
             #:
@@ -356,14 +876,20 @@ class Transaction():
         if not self.amount:
             calculated_amount = self.trade_amount.quantity * self.trade_price.quantity + commission_adjustment.quantity
             self.amount = Amount(calculated_amount, self.from_account.currency)
-            logging.debug(f"calculated_amount: {calculated_amount}")
+            if self.session.trace.prices:
+                self.session.trace.event("prices", "calculated_amount", account=self.from_account.name, date=self.date,
+                            security=self.security.name, amount=calculated_amount)
+            #:
         #:
          
         # price in qif seems to be calculated with inadequate precision
         calculated_price = (self.amount.quantity - commission_adjustment.quantity) / self.trade_amount.quantity
         self.trade_price = Amount(calculated_price, self.from_account.currency, prec=7)
         self.security.add_price(date=self.date, price=self.trade_price)
-        logging.debug(f"calculated_price: {calculated_price}")
+        if self.session.trace.prices:
+            self.session.trace.event("prices", "calculated_price", account=self.from_account.name, date=self.date,
+                        security=self.security.name, price=calculated_price)
+        #:
         
         if self.security.name == "RBC-MANAGED-FUNDS":
             if self.action == "ShrsIn":
@@ -376,6 +902,40 @@ class Transaction():
         #:
     #:
 
+    def digest(self):
+        """ hash of everything posting and emitting this transaction uses """
+
+        def amount(a):
+            return (str(a.quantity), a.security.name, a.prec) if a else repr(a)
+        #:
+        
+        fields = (self.type, self.action, self.date, self.payee, self.memo,
+                  self.from_account.name, self.from_account.currency.name,
+                  self.to_account and (self.to_account.name, self.to_account.currency.name),
+                  amount(self.amount),
+                  [(amount(split["amount"]), split["to_account"].name, split["memo"]) for split in self.splits],
+                  amount(getattr(self, "commission", None)),
+                  getattr(self, "security", None) and self.security.name,
+                  amount(getattr(self, "trade_amount", None)),
+                  amount(getattr(self, "trade_price", None)))
+        return hashlib.blake2b(repr(fields).encode(), digest_size=16).hexdigest()
+    #:
+
+    def links(self):
+        # what posting this transaction shares with others: pending transfers
+        # between two Quicken accounts on one date and the lots of a security
+        for to_account in [self.to_account] + [split["to_account"] for split in self.splits]:
+            if to_account and to_account.q_name.startswith("["):
+                # transfers dated apart may match when there is a window
+                date = None if self.session.transfer_window else self.date
+                yield ("transfer", date, frozenset([self.from_account.name, to_account.name]))
+            #:
+        #:
+        if self.type == "Invst" and getattr(self, "security", None):
+            yield ("lots", self.from_account.name, self.security.name)
+        #:
+    #:
+
     def clean_string(self, s):
 
         if not s:
@@ -389,9 +949,23 @@ class Transaction():
         return s
     #:
 
+    def priority(self):
+        """ 0 for investments, 1 with splits, 2 otherwise: the posting order on a date """
+
+        if self.type == "Invst":
+            return 0
+        elif self.splits:
+            return 1
+        #:
+        return 2
+    #:
+
     def post(self):
 
-        logging.debug(f"Post: {self.q}")
+        if self.session.trace.post:
+            self.session.trace.event("post", "post", account=self.from_account.name, date=self.date, type=self.type,
+                        action=getattr(self, "action", None))
+        #:
         
         if self.type == "Invst":
             self.post_investment()
@@ -406,7 +980,11 @@ class Transaction():
 
     def post_leg(self, account, amount, cost=None, price=None, comment=None):
 
-        logging.debug(f"Post Leg: {account} {amount} cost={cost} price={price} {comment}")
+        if self.session.trace.post:
+            self.session.trace.event("post", "leg", account=account.name, date=self.date, amount=amount, cost=cost, price=price,
+                        comment=comment)
+        #:
+        self.legs.append((account, amount.security))
         
         if (not account.firstdate) or (self.date < account.firstdate):
             account.firstdate = self.date
@@ -445,7 +1023,10 @@ class Transaction():
                                              price=price, comment=removal_comment))
             #:
             if price is not None and removal["cost"]:
-                logging.debug(f"realized_gain {removal['quantity']} {price} {removal['cost']}")
+                if self.session.trace.lots:
+                    self.session.trace.event("lots", "realized_gain", account=account.name, date=self.date,
+                                quantity=removal["quantity"], price=price, cost=removal["cost"])
+                #:
                 if account.currency != removal["cost"].security:
                     raise ValueError("Mismatched currencies")
                 #:
@@ -453,7 +1034,7 @@ class Transaction():
             #:
         #:
         if realized_gain:
-            self.postings.append(Posting(Account.q_names["_RlzdGain"], Amount(-realized_gain, account.currency)))
+            self.postings.append(Posting(self.session.q_names["_RlzdGain"], Amount(-realized_gain, account.currency)))
         #:
     #:
 
@@ -463,7 +1044,6 @@ class Transaction():
             to_account = self.to_account
         #:
         
-        logging.debug(f"Transfer: {self.from_account.q_name} -> {to_account.q_name}")
         if not to_account.q_name.startswith("["):
             # not a quicken account transfer so there will be no matching transaction
             self.post_leg(self.from_account, amount)
@@ -471,28 +1051,19 @@ class Transaction():
             return
         #:
 
-        logging.debug(f"Looking for match: {self.from_account.q_name} -> {to_account.q_name} {self.date} {amount}")
-
-        match_count = 0
-        last_match = None
-        for i, transfer in enumerate(to_account.pending_transfers):
-            if (transfer["to_account"] == self.from_account
-                and transfer["date"] == self.date
-                and (self.from_account.currency != to_account.currency or transfer["amount"] == -amount)):
-                match_count += 1
-                last_match = i
-                logging.debug("Match")
-            #:
+        match_count, transfer = to_account.match_transfer(self.from_account, self.date, amount)
+        if self.session.trace.transfers:
+            self.session.trace.event("transfers", "match", account=self.from_account.name, to_account=to_account.name,
+                        date=self.date, amount=amount, matches=match_count, pended=transfer and transfer["date"])
         #:
 
         if match_count == 0:
 
-            logging.debug(f"No match: {self.date} {self.from_account.name} -> {to_account.name} {amount}")
-
+            self.session.metrics.count("transfers.pended")
             from_posting = self.post_leg(self.from_account, amount=amount, comment=comment)
             to_posting = self.post_leg(to_account, amount=-amount, comment=comment)
             
-            self.from_account.pending_transfers.append(
+            self.from_account.pend_transfer(
                 {"date": self.date,
                  "to_account": to_account,
                  "amount": amount,
@@ -500,25 +1071,23 @@ class Transaction():
                  "to_posting": to_posting
                  })
 
-            logging.debug(f"Pend transfer: {self.date} {to_account.name} {amount}")
-
             return
         #:
             
+        self.session.metrics.count("transfers.matched")
         if match_count > 1:
+            self.session.metrics.count("transfers.ambiguous")
             logging.error(f"Multiple match: {self.date} {self.from_account.name} -> {to_account.name} {amount}")
         #:
 
         if match_count >= 1:
-            logging.debug(f"Found match: {self.date} {self.from_account.name} -> {to_account.name} {amount}")
-
-            transfer = to_account.pending_transfers.pop(last_match)
-            logging.debug(f"Popped: {transfer}")
-
             if self.from_account.currency != to_account.currency:
-                logging.debug("Currency Exchange")
                 from_amount = transfer["amount"]
                 rate = from_amount.quantity / -amount.quantity 
+                if self.session.trace.transfers:
+                    self.session.trace.event("transfers", "exchange", account=self.from_account.name, to_account=to_account.name,
+                                date=self.date, amount=amount, rate=rate)
+                #:
 
                 prev_posting = transfer["to_posting"]
                 prev_posting.amount = amount
@@ -530,10 +1099,6 @@ class Transaction():
 
     def post_investment(self):
         
-        logging.debug(f"Post investment")
-        logging.debug(f"{self.q}")
-        logging.debug(f"self.action: {self.action}")
-
         if not self.amount and not self.trade_amount:
             logging.error(f"Null transaction: {self.q}")
             return
@@ -562,23 +1127,23 @@ class Transaction():
             self.post_transfer(-self.amount)
         elif self.action == "Div":
             self.post_leg(self.from_account, self.amount, comment=comment)
-            self.post_leg(Account.q_names["_DivInc"], -self.amount)
+            self.post_leg(self.session.q_names["_DivInc"], -self.amount)
         elif self.action == "DivX":
             self.post_leg(self.from_account, self.amount, comment=comment)
-            self.post_leg(Account.q_names["_DivInc"], -self.amount)
+            self.post_leg(self.session.q_names["_DivInc"], -self.amount)
             self.post_transfer(-self.amount)
         elif self.action == "IntInc":
             self.post_leg(self.from_account, self.amount)
-            self.post_leg(Account.q_names[f"_IntInc"], -self.amount)
+            self.post_leg(self.session.q_names[f"_IntInc"], -self.amount)
         elif self.action == "ReinvInt":
             self.post_leg(self.from_account, self.trade_amount, cost=self.trade_price)
-            self.post_leg(Account.q_names[f"_IntInc"], -self.amount)
+            self.post_leg(self.session.q_names[f"_IntInc"], -self.amount)
         elif self.action == "ReinvDiv":
             self.post_leg(self.from_account, self.trade_amount, cost=self.trade_price)
             if self.amount:
-                self.post_leg(Account.q_names[f"_DivInc"], -self.amount)
+                self.post_leg(self.session.q_names[f"_DivInc"], -self.amount)
             else:
-                self.post_leg(Account.q_names[f"_DivInc"], -self.trade_amount)
+                self.post_leg(self.session.q_names[f"_DivInc"], -self.trade_amount)
             #:
         elif self.action == "XIn":
             self.post_transfer(self.amount)
@@ -588,33 +1153,36 @@ class Transaction():
             self.post_transfer(self.amount)
         elif self.action == "ShrsIn":
             self.post_leg(self.from_account, self.trade_amount, cost=self.trade_price)
-            self.post_leg(Account.q_names["_ShrsInOut"], -self.amount)
+            self.post_leg(self.session.q_names["_ShrsInOut"], -self.amount)
         elif self.action == "ShrsOut":
-            logging.debug(f"trade amount: {self.trade_amount}")
             self.post_leg(self.from_account, -self.trade_amount, price=self.trade_price)
-            self.post_leg(Account.q_names["_ShrsInOut"], self.amount)
+            self.post_leg(self.session.q_names["_ShrsInOut"], self.amount)
         elif self.action == "MiscIncX":
             self.post_transfer(-self.amount)
         elif self.action == "MiscExpX":
             self.post_transfer(self.amount)
         elif self.action == "MargInt":
             self.post_leg(self.from_account, -self.amount)
-            self.post_leg(Account.q_names["_IntExp"], self.amount)
+            self.post_leg(self.session.q_names["_IntExp"], self.amount)
         elif self.action == "CGShort":
             self.post_leg(self.from_account, self.amount)
-            self.post_leg(Account.q_names["_ST CapGnDst"], -self.amount)
+            self.post_leg(self.session.q_names["_ST CapGnDst"], -self.amount)
         elif self.action == "StkSplit":
-            logging.debug(f"StkSplit: {self.trade_amount}")
-            logging.debug(f"{pprint.pformat(self.from_account.holdings)}")
             split_factor = self.trade_amount.quantity / decimal.Decimal(10)
-            for holding in list(self.from_account.holdings.get(self.trade_amount.security.name, [])):
+            lots = self.from_account.holdings.get(self.trade_amount.security.name)
+            # every lot is removed before the split lots are added so that
+            # each removal leg books the lot it names whatever the booking
+            holdings = lots.in_order() if lots else []
+            for holding in holdings:
+                self.post_leg(self.from_account, -Amount(holding["quantity"], holding["security"], prec=7), price=holding["cost"])
+            #:
+            for holding in holdings:
                 if holding["cost"]:
                     new_cost = Amount(holding["cost"].quantity / split_factor, holding["cost"].security, prec=7)
                 else:
                     new_cost = None
                 #:
                 new_trade_amount = Amount(holding["quantity"] * split_factor, holding["security"], prec=7)
-                self.post_leg(self.from_account, -Amount(holding["quantity"], holding["security"], prec=7), price=holding["cost"])
                 self.post_leg(self.from_account, new_trade_amount, cost=new_cost)
             #:
         elif self.action == "CGLong":
@@ -622,18 +1190,15 @@ class Transaction():
         elif self.action == "Reminder":
             logging.error("Ignored: %s\n" % self.action)
         else:
-            logging.error("unhandled: %s\n" % self.action)
-            sys.exit()
+            raise ValueError(f"Unhandled action: {self.action}")
         #:
 
         if self.commission:
-            self.post_leg(Account.q_names["_Commissions"], self.commission)
+            self.post_leg(self.session.q_names["_Commissions"], self.commission)
         #:
     #:
     
     def post_splits(self):
-    
-        logging.debug(f"Processing splits")
 
         for split in self.splits:
             self.post_transfer(split["amount"], to_account=split["to_account"], comment=split["memo"])
@@ -646,13 +1211,14 @@ class Transaction():
     #:
 
     def emit(self):
+        self.session.output.write(self.render())
+    #:
 
-        for posting in self.postings:
-            if posting:
-                break
-            #:
-        else:
-            return
+    def render(self):
+        """ the Beancount text of the transaction, "" when it has no postings """
+
+        if not self.postings:
+            return ""
         #:
         
         date = self.date.strftime("%Y-%m-%d")
@@ -664,32 +1230,36 @@ class Transaction():
         comments.extend([posting.comment for posting in self.postings if posting.comment])
         comments = "/".join(comments)
 
-        print("")
-        print(f'{date} * "{self.payee}" "{comments}"')
+        lines = ["", f'{date} * "{self.payee}" "{comments}"']
 
-        summary = list(self.postings)
-        
-        for i, posting in enumerate(summary):
-            if i == 0:
-                continue
-            #:
-            if posting.comment:
-                continue
-            #:
-            for j in range(i):
-                if (summary[j].account == posting.account
-                    and summary[j].cost == posting.cost
-                    and summary[j].price == posting.price
-                    and not posting.comment):
-                    summary[j].amount += posting.amount
-                    posting.amount.quantity = decimal.Decimal('0')
+        # a posting without a comment is merged into the first posting to
+        # the same account of the same security at the same cost and price;
+        # the sums are new Amounts, postings and their amounts are left alone
+
+        summary = []
+        first = {}
+        for posting in self.postings:
+            posting_key = (posting.account, posting.amount.security, posting.cost, posting.price)
+            i = first.get(posting_key)
+            if i is not None and not posting.comment:
+                summary[i][1] = summary[i][1] + posting.amount
+            else:
+                if i is None:
+                    first[posting_key] = len(summary)
                 #:
+                summary.append([posting, posting.amount])
             #:
         #:
+
+        self.session.metrics.count("emit.postings", len(self.postings))
+        self.session.metrics.count("emit.merged", len(self.postings) - len(summary))
             
-        for posting in summary:
+        for posting, amount in summary:
 
-            logging.debug(f"Emit: {posting.account.name} {posting.amount} price={posting.price} cost={posting.cost} {posting.comment}")
+            if self.session.trace.emit:
+                self.session.trace.event("emit", "posting", account=posting.account.name, date=self.date, amount=amount,
+                            price=posting.price, cost=posting.cost, comment=posting.comment)
+            #:
             
             if posting.comment:
                 comment = f" ; {posting.comment}"
@@ -697,40 +1267,65 @@ class Transaction():
                 comment = ""
             #:
 
-            if not posting.amount:
+            if not amount:
                 continue
             #:
             
             if posting.cost is not None:
-                #print(f"  {posting.account.name:40} {posting.amount} {{{posting.cost}}}{comment}")
-                print(f"  {posting.account.name:40} {posting.amount} @ {posting.cost}{comment}")
+                #lines.append(f"{posting.account.column} {amount} {{{posting.cost}}}{comment}")
+                lines.append(f"{posting.account.column} {amount} @ {posting.cost}{comment}")
             elif posting.price is not None:
-                print(f"  {posting.account.name:40} {posting.amount} @ {posting.price}{comment}")
+                lines.append(f"{posting.account.column} {amount} @ {posting.price}{comment}")
             else:
-                print(f"  {posting.account.name:40} {posting.amount}{comment}")
+                lines.append(f"{posting.account.column} {amount}{comment}")
             #:
         #:
+        lines.append("")
+        return "\n".join(lines)
     #:
 #:
 
-class Amount():
+class Amount(object):
+    """ an immutable quantity of a security, shown with prec decimals
+
+    The quantity is the Decimal it was given (other numbers are converted
+    through str), so it round-trips exactly; the security is the one
+    Security object of that name.  Amounts are equal, and hash alike, when
+    quantity and security are, whatever their prec.
+    """
+
+    __slots__ = ("quantity", "security", "prec")
+
     def __init__(self, quantity=None, security=None, prec=2):
 
-        if quantity:
-            self.quantity = decimal.Decimal(str(quantity))
-        else:
-            self.quantity = decimal.Decimal()
+        if not quantity:
+            quantity = ZERO
+        elif type(quantity) is not decimal.Decimal:
+            quantity = decimal.Decimal(str(quantity))
         #:
 
-        self.security = security
-        self.prec = prec
+        object.__setattr__(self, "quantity", quantity)
+        object.__setattr__(self, "security", security)
+        object.__setattr__(self, "prec", prec)
+    #:
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"Amount is immutable: cannot set {name}")
+    #:
+
+    def __reduce__(self):
+        return (Amount, (self.quantity, self.security, self.prec))
     #:
 
     def __eq__(self, amount):
         if amount is None:
             return False
         #:
-        return (self.quantity == amount.quantity and self.security == amount.security)
+        return (self.quantity == amount.quantity and self.security is amount.security)
+    #:
+
+    def __hash__(self):
+        return hash((self.quantity, id(self.security)))
     #:
 
     def __neg__(self):
@@ -756,23 +1351,20 @@ class Amount():
     #:
     
     def __str__(self):
+
         # remove exponents and trailing zeros if present
         # integers remain integers, floating will have at least two decimal points
 
-        d = self.quantity
-        
-        if "." not in str(d):
-            d = d.quantize(decimal.Decimal("1"))
-            return f"{d} {self.security.name}"
+        prec = self.prec if "." in str(self.quantity) else 0
+        exponent = exponents.get(prec)
+        if exponent is None:
+            exponent = exponents[prec] = decimal.Decimal(1).scaleb(-prec)
         #:
-
-        d = d.quantize(decimal.Decimal("1." + ("0" * self.prec)))
-
-        return f"{d} {self.security.name}"
+        return f"{self.quantity.quantize(exponent)} {self.security.name}"
     #:
 
     def __bool__(self):
-        return self.quantity != decimal.Decimal("0")
+        return self.quantity != ZERO
     #:
 #:
 
@@ -780,7 +1372,6 @@ class Posting():
     
     def __init__(self, account=None, amount=None, price=None, cost=None, comment=None):
 
-        logging.debug(f"Posting: {account.name} {amount} price={price} cost={cost} {comment}")
         self.account = account
         self.amount = amount
         self.price = price
@@ -793,127 +1384,583 @@ class Posting():
     #:
 #:
 
-if __name__ == "__main__":
-    
-    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
-    logging.debug("Started...")
-    
-    print('option "title" "Tansay"')
-    print('option "operating_currency" "CAD"')
-    print('option "booking_method" "FIFO"')
-    print('option "inferred_tolerance_default" "*:0.001"')
-    print('option "inferred_tolerance_multiplier" "1.2"')
-    print('')
-    print('plugin "beancount.plugins.implicit_prices"')
-    print('')
-    print('1901-01-01 custom "fava-extension" "fava_dashboards"')
-    print('1901-01-01 custom "fava-option" "show-accounts-with-zero-balance" "True"')
-    print('1901-01-01 custom "fava-option" "collapse-pattern" ".*:.*"')
-    print('')
-    
-    qif = qifparser.Qif(sys.argv[1])
+class Group():
+    """ transactions that are posted independently of all others
 
-    # create currencies
+    Members are linked by Transaction.links(); their Beancount text only
+    depends on the members' digests and order, so a group seen by an
+    earlier run (same digest) can reuse that run's results.
+    """
 
-    Security("CAD")
-    Security("USD")
+    def __init__(self, members):
+        self.members = members
+        self.digest = hashlib.blake2b("".join(member.digest() for member in members).encode(),
+                                      digest_size=16).hexdigest()
+        self.saved = None
+    #:
 
-    # create accounts for implicit categories
+    @staticmethod
+    def find(order):
+        """ the groups of the transactions in posting order """
 
-    Account(q_name="_OpeningBalances")
-    Account(q_name="_Commissions") 
-    Account(q_name="_ShrsInOut")
+        parent = list(range(len(order)))
 
-    # create accounts for Quicken categories
-    
-    for category in qif.categories.values():
-        account = Account(q_category=category)
+        def root(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            #:
+            return i
+        #:
+
+        owners = {}
+        for i, transaction in enumerate(order):
+            for link in transaction.links():
+                j = owners.setdefault(link, i)
+                parent[root(i)] = root(j)
+            #:
+        #:
+
+        members = {}
+        for i, transaction in enumerate(order):
+            transaction.position = i
+            members.setdefault(root(i), []).append(transaction)
+        #:
+
+        groups = [Group(group) for group in members.values()]
+        for group in groups:
+            for i, transaction in enumerate(group.members):
+                transaction.group = group
+                transaction.index = i
+            #:
+        #:
+        return groups
     #:
 
-    # create accounts for user-defined Quicken accounts
-    
-    for q_account in qif.accounts.values():
-        account = Account(q_account=q_account)
+    def record(self, texts, by_posting):
+        """ what a later run needs to reuse this freshly posted group """
+
+        lastdates = {}
+        holdings = set()
+        for member in self.members:
+            for account, security in member.legs:
+                if not lastdates.get(account.name) or member.date > lastdates[account.name]:
+                    lastdates[account.name] = member.date
+                #:
+                if security != account.currency and account.holdings.get(security.name):
+                    holdings.add(account.name)
+                #:
+            #:
+        #:
+
+        unmatched = []
+        for member in self.members:
+            for posting in member.postings:
+                for account, transfer in by_posting.get(id(posting), []):
+                    unmatched.append((member.index, account.name, unmatched_message(account, transfer)))
+                #:
+            #:
+        #:
+
+        return {"texts": [texts[member] for member in self.members],
+                "lastdates": lastdates,
+                "holdings": holdings,
+                "unmatched": unmatched}
+    #:
+#:
+
+def unmatched_message(account, transfer):
+    return f"Unmatched: {transfer['date']} {transfer['amount']} {account.name} -> {transfer['to_account'].name}"
+#:
+
+# State files start with STATE_MAGIC and a line of JSON holding the state
+# version, which is compared before the groups are unpickled, as for the
+# parse caches of qifparser.
+STATE_MAGIC = b"q2b state\n"
+STATE_VERSION = 2
+
+def state_version(booking, transfer_window, mapping):
+    # any change to the conversion invalidates saved groups
+    with open(__file__, "rb") as fh:
+        return f"{STATE_VERSION} {booking} {transfer_window} {mapping.digest} {hashlib.blake2b(fh.read()).hexdigest()}"
     #:
+#:
 
-    # create securities
-    
-    for q_account in qif.accounts.values():
-        for q_transaction in q_account.transactions:
-            if q_transaction.qtype == "Invst" and q_transaction.security:
-                if not Security.dict.get(q_transaction.security):
-                    Security(q_transaction.security)
+def load_state(filename, version):
+    """ saved groups by digest, empty if there are none to reuse """
+
+    try:
+        with open(filename, "rb") as fh:
+            if fh.read(len(STATE_MAGIC)) != STATE_MAGIC:
+                raise ValueError("not a q2b state file")
+            #:
+            if json.loads(fh.readline()).get("version") != version:
+                logging.info(f"State file {filename} is from another version, converting everything")
+                return {}
+            #:
+            return pickle.load(fh)
+        #:
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logging.error(f"Ignoring state file {filename}: {e}")
+        return {}
+    #:
+#:
+
+def save_state(filename, version, groups):
+
+    temp = f"{filename}.{os.getpid()}.tmp"
+    with open(temp, "wb") as fh:
+        fh.write(STATE_MAGIC)
+        fh.write(json.dumps({"version": version}).encode() + b"\n")
+        pickle.dump(groups, fh, pickle.HIGHEST_PROTOCOL)
+    #:
+    os.replace(temp, filename)
+#:
+
+class Converter(object):
+    """ one conversion of a QIF file into a Beancount file
+
+    The converter owns everything a conversion creates (accounts by name
+    and by Quicken name, securities, pending transfers...), so any number
+    of them can run side by side in threads or processes.  options is a
+    dict with any of the keys of Converter.defaults:
+
+      booking           how lots are matched to sales, one of Lots.bookings
+      transfer_window   how many days apart the two sides of a transfer may be
+      state             --state file reused and rewritten by run()
+      mapping           account and security name rules: a Mapping, the name of
+                        a JSON file for Mapping.load() or a dict for Mapping()
+      cache, jobs       passed to qifparser.Qif when run() is given a file name
+      emit_order        "date" for a date ordered Beancount file, "account" for
+                        the transactions of each account together
+
+    output is where the Beancount text is written, trace a Tracer and
+    metrics the Metrics of the run.
+    """
+
+    defaults = {"booking": "FIFO", "transfer_window": 0, "state": None, "mapping": None, "cache": None, "jobs": None,
+                "emit_order": "date"}
+
+    def __init__(self, options=None, output=None, trace=None, metrics=None):
+
+        options = dict(options or {})
+        unknown = set(options) - set(self.defaults)
+        if unknown:
+            raise ValueError(f"Unknown options: {', '.join(sorted(unknown))}")
+        #:
+        for name, default in self.defaults.items():
+            setattr(self, name, options.get(name, default))
+        #:
+        if self.booking not in Lots.bookings:
+            raise ValueError(f"Unknown booking method: {self.booking}")
+        #:
+        if self.emit_order not in ("date", "account"):
+            raise ValueError(f"Unknown emit order: {self.emit_order}")
+        #:
+
+        if not isinstance(self.mapping, Mapping):
+            self.mapping = Mapping.load(self.mapping) if isinstance(self.mapping, str) else Mapping(self.mapping)
+        #:
+
+        self.output = output if output is not None else io.StringIO()
+        self.trace = trace if trace is not None else Tracer()
+        self.metrics = metrics if metrics is not None else Metrics()
+
+        self.names = {}
+        self.q_names = {}
+        self.securities = {}
+        self.transfer_sequence = itertools.count()
+        self.transaction_count = itertools.count(1)
+        # accounts holding lots in the reused groups of post_incremental
+        self.held = set()
+    #:
+
+    def run(self, qif):
+        """ convert qif, a file name, a streaming qifparser.Qif not yet read or a qifcolumns.ColumnStore """
+
+        if isinstance(qif, qifparser.Qif):
+            if qif.consumed:
+                # an eager Qif has read its records before they could be converted
+                raise ValueError("The Qif records have already been read: pass a file name or a Qif(stream=True)")
+            #:
+        elif not hasattr(qif, "iter_records"):
+            qif = qifparser.Qif(qif, stream=True, cache=self.cache, jobs=self.jobs)
+        #:
+
+        self.write_header()
+        self.load(qif)
+        with self.metrics.stage("order"):
+            order = self.posting_order()
+        #:
+        self.metrics.count("transactions", len(order))
+        if self.state:
+            self.post_incremental(order)
+        else:
+            self.post(order)
+            with self.metrics.stage("emit"):
+                for text in self.render_all(self.in_file_order()):
+                    self.output.write(text)
                 #:
             #:
+            self.report_unmatched([(None, None, account, unmatched_message(account, transfer))
+                                   for account in self.names.values()
+                                   for transfer in account.pending_transfers.values()])
+        #:
+        with self.metrics.stage("close"):
+            self.close_accounts()
         #:
     #:
-    
-    # load Quicken transactions into accounts
-    
-    for q_account in qif.accounts.values():
-        account = Account.q_names[f"[{q_account.qname}]"]
-        for q_transaction in q_account.transactions:
-            account.transactions.append(Transaction(account, q_transaction))
+
+    def write_header(self):
+
+        output = self.output
+        output.write('option "title" "Tansay"\n')
+        output.write(f'option "operating_currency" "{self.mapping.currency}"\n')
+        output.write(f'option "booking_method" "{self.booking}"\n')
+        output.write('option "inferred_tolerance_default" "*:0.001"\n')
+        output.write('option "inferred_tolerance_multiplier" "1.2"\n')
+        output.write('\n')
+        output.write('plugin "beancount.plugins.implicit_prices"\n')
+        output.write('\n')
+        output.write('1901-01-01 custom "fava-extension" "fava_dashboards"\n')
+        output.write('1901-01-01 custom "fava-option" "show-accounts-with-zero-balance" "True"\n')
+        output.write('1901-01-01 custom "fava-option" "collapse-pattern" ".*:.*"\n')
+        output.write('\n')
+    #:
+
+    def load(self, qif):
+
+        # create currencies
+
+        for currency in self.mapping.all_currencies():
+            Security(self, currency)
+        #:
+
+        # create accounts for implicit categories
+
+        Account(self, q_name="_OpeningBalances")
+        Account(self, q_name="_Commissions") 
+        Account(self, q_name="_ShrsInOut")
+
+        # Single pass over the QIF records:
+        # - create accounts for Quicken categories and user-defined Quicken accounts
+        # - create securities as investment transactions refer to them
+        # - collect the price history, which Quicken quotes by symbol
+        # Quicken lists every account ahead of the transaction blocks in an
+        # "all accounts" export, so transfer targets already exist when needed.
+        # The price history comes last, so the transactions, which look up
+        # prices, are only loaded into their accounts once it has been read.
+        # The time spent parsing is counted apart from the rest.
+
+        with self.metrics.stage("accounts"):
+            records = []
+            symbols = {}
+            quotes = {}
+            for record in self.metrics.timed("parse", qif.iter_records()):
+                if isinstance(record, qifparser.Category):
+                    Account(self, q_category=record)
+                elif isinstance(record, qifparser.Account):
+                    Account(self, q_account=record)
+                elif isinstance(record, qifparser.Security):
+                    symbols[record.symbol or record.qname] = record.qname
+                elif isinstance(record, qifparser.Price):
+                    q_name = symbols.get(record.security, record.security)
+                    quotes.setdefault(q_name, []).append((record.date, record.price))
+                else:
+                    # a qifparser.Transaction, or a qifcolumns.TransactionView
+                    # from a ColumnStore, which q2b does not import for NumPy's sake
+                    if record.qtype == "Invst" and record.security:
+                        if not self.securities.get(record.security):
+                            Security(self, record.security)
+                        #:
+                    #:
+                    records.append(record)
+                #:
+            #:
+
+            for q_name, security_quotes in quotes.items():
+                if q_name in self.securities:
+                    self.securities[q_name].load_prices(security_quotes)
+                #:
+            #:
+        #:
+
+        # Trades without a price take it from the price history, so they are
+        # priced once every trade with a price has been added to it, in date
+        # order, whatever account they are in.
+
+        with self.metrics.stage("transactions"):
+            unpriced = []
+            for record in records:
+                account = self.q_names[f"[{record.account.qname}]"]
+                transaction = Transaction(account, record)
+                account.transactions.append(transaction)
+                if getattr(transaction, "trade_amount", None) is not None and transaction.trade_price is None:
+                    unpriced.append(transaction)
+                #:
+            #:
+            unpriced.sort(key=lambda transaction: transaction.date or datetime.datetime.min)
+            for transaction in unpriced:
+                transaction.price_trade()
+            #:
         #:
     #:
-    
-    # Pass 1 -- process investments
-    # Multiple passes used so that account transfers appear preferentially with their investments
 
-    for account in Account.names.values():
-        for transaction in account.transactions:
-            if transaction.type == "Invst" and not transaction.posted:
-                transaction.post()
+    def posting_order(self):
+        """ all transactions in the order they are posted
+
+        Transactions are posted once each, in date order.  On the same date
+        investments come first, then transactions with splits, then the
+        rest, so that account transfers appear preferentially with their
+        investments; ties are taken in account order.
+        """
+
+        queue = []
+        for number, account in enumerate(self.names.values()):
+            for position, transaction in enumerate(account.transactions):
+                queue.append((transaction.date or datetime.datetime.min, transaction.priority(),
+                              number, position, transaction))
             #:
         #:
+        heapq.heapify(queue)
+        return [heapq.heappop(queue)[-1] for _ in range(len(queue))]
     #:
 
-    # Pass 2 -- process splits 
+    def post(self, transactions):
+        """ post transactions, timing each kind apart with fine metrics """
 
-    for account in Account.names.values():
-        for transaction in account.transactions:
-            if transaction.splits and not transaction.posted:
-                transaction.post()
+        metrics = self.metrics
+        with metrics.stage("post"):
+            if not metrics.fine:
+                for transaction in transactions:
+                    transaction.post()
+                #:
+                return
+            #:
+            for transaction in transactions:
+                metrics.start(POST_STAGES[transaction.priority()])
+                try:
+                    transaction.post()
+                finally:
+                    metrics.stop()
+                #:
             #:
         #:
     #:
 
-    # Pass 3 -- process the rest 
+    def post_incremental(self, order):
+        """ post and emit only the groups that changed since the last run
+
+        The Beancount text, unmatched transfers, last dates and holdings of
+        the other groups are taken from the state file, which is rewritten.
+        """
 
-    for account in Account.names.values():
-        for transaction in account.transactions:
-            if not transaction.posted:
-                transaction.post()
+        version = state_version(self.booking, self.transfer_window, self.mapping)
+        saved = load_state(self.state, version)
+        groups = Group.find(order)
+        for group in groups:
+            group.saved = saved.get(group.digest)
+        #:
+        reused = sum(1 for group in groups if group.saved)
+        self.metrics.count("state.groups", len(groups))
+        self.metrics.count("state.reused", reused)
+        logging.info(f"Reusing {reused} of {len(groups)} transaction groups")
+
+        self.post([transaction for transaction in order if not transaction.group.saved])
+
+        with self.metrics.stage("emit"):
+            fresh = [transaction for transaction in self.in_file_order() if not transaction.group.saved]
+            texts = dict(zip(fresh, self.render_all(fresh)))
+            for transaction in self.in_file_order():
+                if transaction.group.saved:
+                    self.output.write(transaction.group.saved["texts"][transaction.index])
+                else:
+                    self.output.write(texts[transaction])
+                #:
+            #:
+        #:
+
+        by_posting = {}
+        for account in self.names.values():
+            for transfer in account.pending_transfers.values():
+                by_posting.setdefault(id(transfer["from_posting"]), []).append((account, transfer))
             #:
         #:
+        results = {}
+        for group in groups:
+            if not group.saved:
+                group.saved = group.record(texts, by_posting)
+            #:
+            results[group.digest] = group.saved
+        #:
+        save_state(self.state, version, results)
+
+        unmatched = []
+        accounts = {name: i for i, name in enumerate(self.names)}
+        for group in groups:
+            for i, name, message in group.saved["unmatched"]:
+                unmatched.append((accounts[name], group.members[i].position, self.names[name], message))
+            #:
+            for name, lastdate in group.saved["lastdates"].items():
+                account = self.names[name]
+                if not account.lastdate or lastdate > account.lastdate:
+                    account.lastdate = lastdate
+                #:
+            #:
+            for name in group.saved["holdings"]:
+                self.held.add(name)
+            #:
+        #:
+        unmatched.sort(key=lambda entry: entry[:2])
+        self.report_unmatched(unmatched)
     #:
 
-    # Emit transactions
+    def in_file_order(self):
+        """ all transactions in the order of the Beancount file
+
+        By date: each account's transactions are sorted once (they usually
+        nearly are) and the accounts merged, transactions of the same date
+        following account order.  By account: account after account.
+        """
 
-    for account in Account.names.values():
-        for transaction in account.transactions:
-            transaction.emit()
+        if self.emit_order == "account":
+            return (transaction for account in self.names.values() for transaction in account.transactions)
         #:
+        key = lambda transaction: transaction.date or datetime.datetime.min
+        return heapq.merge(*[sorted(account.transactions, key=key) for account in self.names.values()], key=key)
     #:
 
-    # List unmatched transactions
-    
-    for account in Account.names.values():
-        if account.pending_transfers:
-            logging.error(f"Unmatched transactions in {account.name}")
-            for transfer in account.pending_transfers:
-                logging.error(f"Unmatched: {transfer['date']} {transfer['amount']} {account.name} -> {transfer['to_account'].name}")
+    def render_all(self, transactions):
+        """ the Beancount text of each transaction, in order """
+
+        for transaction in transactions:
+            yield transaction.render()
+        #:
+    #:
+
+    def report_unmatched(self, unmatched):
+
+        self.metrics.count("transfers.unmatched", len(unmatched))
+
+        last_account = None
+        for _, _, account, message in unmatched:
+            if account is not last_account:
+                logging.error(f"Unmatched transactions in {account.name}")
+                last_account = account
+            #:
+            logging.error(message)
+        #:
+    #:
+
+    def close_accounts(self):
+
+        as_of = datetime.datetime(datetime.datetime.today().year - 2, 1, 1)
+
+        for account in self.names.values():
+            if (not account.holdings and account.name not in self.held
+                and (not account.lastdate or account.lastdate < as_of)):
+                account.close(as_of)
             #:
         #:
     #:
+#:
+
+def convert(qif, options=None):
+    """ the Beancount text of qif, a file name, a streaming qifparser.Qif not yet read or a qifcolumns.ColumnStore
+
+    options as for Converter.  Messages are logged as by q2b.py.
+    """
 
-    # Close unused accounts
+    converter = Converter(options)
+    converter.run(qif)
+    return converter.output.getvalue()
+#:
+
+if __name__ == "__main__":
 
-    as_of = datetime.datetime(datetime.datetime.today().year - 2, 1, 1)
+    parser = argparse.ArgumentParser(description="Translate a Quicken .qif file into a beancount file")
+    parser.add_argument("qif", help="QIF export of all accounts")
+    parser.add_argument("-o", "--output", help="write the Beancount file to OUTPUT instead of stdout")
+    parser.add_argument("--cache", action="store_true",
+                        help="keep the parsed file in a cache and reuse it while the file is unchanged")
+    parser.add_argument("--cache-file", help="parse cache file, implies --cache (default: QIF.cache)")
+    parser.add_argument("--clear-cache", action="store_true", help="remove the parse cache before starting")
+    parser.add_argument("-j", "--jobs", type=int, help="parse with this many processes (0: one per CPU)")
+    parser.add_argument("--emit-order", choices=("date", "account"), default=Converter.defaults["emit_order"],
+                        help="order of the transactions in the Beancount file (default: %(default)s)")
+    parser.add_argument("--mapping", metavar="FILE",
+                        help="JSON file of account, security and currency name rules (see q2b.Mapping)")
+    parser.add_argument("--booking", choices=Lots.bookings, default=Converter.defaults["booking"],
+                        help="which lots sales are taken from (default: %(default)s)")
+    parser.add_argument("--transfer-window", type=int, default=Converter.defaults["transfer_window"], metavar="DAYS",
+                        help="match the two sides of a transfer up to DAYS days apart (default: %(default)s)")
+    parser.add_argument("--trace", metavar="SUBSYSTEMS",
+                        help="write trace events for these comma separated subsystems (%s, or all)"
+                        % ", ".join(Tracer.subsystems))
+    parser.add_argument("--trace-file", help="write the trace events to TRACE_FILE instead of stderr")
+    parser.add_argument("--trace-account", action="append", metavar="ACCOUNT",
+                        help="only trace events about this Beancount account (may be repeated)")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="write the time and memory growth of each stage and event counts to FILE as JSON")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="run under cProfile and save the statistics to FILE (see pstats; "
+                        "--jobs workers are not profiled)")
+    parser.add_argument("--state", help="keep the results of this run in STATE and reuse the unchanged ones "
+                        "from the previous run (messages about reused transactions are not repeated)")
+    args = parser.parse_args()
+
+    # one large buffer instead of a write per line
+    if args.output:
+        output = open(args.output, "w", buffering=OUTPUT_BUFFER)
+    else:
+        output = open(sys.stdout.fileno(), "w", buffering=OUTPUT_BUFFER,
+                      encoding=sys.stdout.encoding, closefd=False)
+    #:
+    atexit.register(output.close)
+
+    trace = Tracer()
+    if args.trace:
+        subsystems = Tracer.subsystems if args.trace == "all" else args.trace.split(",")
+        unknown = set(subsystems) - set(Tracer.subsystems)
+        if unknown:
+            parser.error(f"unknown trace subsystem: {', '.join(sorted(unknown))}")
+        #:
+        trace_file = open(args.trace_file, "w", buffering=OUTPUT_BUFFER) if args.trace_file else sys.stderr
+        atexit.register(trace_file.flush)
+        trace.enable(subsystems, trace_file, args.trace_account)
+    #:
 
-    for account in Account.names.values():
-        if not account.holdings and (not account.lastdate or account.lastdate < as_of):
-            account.close(as_of)
+    cache_file = args.cache_file or f"{args.qif}.cache"
+    cache = cache_file if args.cache or args.cache_file else None
+    if args.clear_cache:
+        qifparser.clear_cache(cache_file)
+    #:
+    
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    logging.debug("Started...")
+    
+    options = {"booking": args.booking,
+               "transfer_window": args.transfer_window,
+               "state": args.state,
+               "mapping": args.mapping,
+               "cache": cache,
+               "jobs": args.jobs,
+               "emit_order": args.emit_order}
+    converter = Converter(options, output, trace, Metrics(fine=bool(args.metrics)))
+    if args.profile:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.runcall(converter.run, args.qif)
+        profile.dump_stats(args.profile)
+    else:
+        converter.run(args.qif)
+    #:
+    if args.metrics:
+        with open(args.metrics, "w") as fh:
+            json.dump(converter.metrics.report(), fh, indent=2)
+            fh.write("\n")
         #:
     #:
 #:
@@ -0,0 +1,147 @@
+#!/usr/bin/python3
+
+""" time each stage of q2b on synthetic QIF files of growing size
+
+usage: q2bbench.py [--sizes N,N,...] [--repeat R] [--tolerance T]
+
+For every size qifgen.py writes a file of about that many transactions,
+which is converted stage by stage:
+
+  parse         qifparser reads every record
+  load          the Converter creates accounts, securities and transactions
+  order         the posting order is worked out
+  post:invst    investments are posted
+  post:splits   transactions with splits are posted
+  post:other    all other transactions are posted
+  emit          the Beancount text is rendered
+
+Each stage is reported in seconds and in microseconds per transaction,
+the best of R runs.  Between two sizes a stage grows as n**k; when k
+exceeds 1 + T for a stage taking at least NOISE seconds at the smaller
+size, the growth is flagged as super-linear and the exit status is 1.
+"""
+
+import io
+import os
+import sys
+import math
+import time
+import logging
+import tempfile
+import argparse
+import qifparser
+import qifgen
+import q2b
+
+STAGES = ("parse", "load", "order", "post:invst", "post:splits", "post:other", "emit")
+
+# stages faster than this are too noisy to judge their growth
+NOISE = 0.1
+
+class Parsed(object):
+    # records parsed beforehand, for Converter.load()
+
+    def __init__(self, records):
+        self.records = records
+    #:
+
+    def iter_records(self):
+        return iter(self.records)
+    #:
+#:
+
+def run_stages(filename):
+    """ {stage: CPU seconds} of one conversion of filename """
+
+    times = dict.fromkeys(STAGES, 0.0)
+
+    start = time.process_time()
+    records = list(qifparser.Qif(filename, stream=True).iter_records())
+    times["parse"] = time.process_time() - start
+
+    converter = q2b.Converter(output=io.StringIO())
+    start = time.process_time()
+    converter.load(Parsed(records))
+    times["load"] = time.process_time() - start
+
+    start = time.process_time()
+    order = converter.posting_order()
+    times["order"] = time.process_time() - start
+
+    for transaction in order:
+        stage = q2b.POST_STAGES[transaction.priority()]
+        start = time.process_time()
+        transaction.post()
+        times[stage] += time.process_time() - start
+    #:
+
+    start = time.process_time()
+    for text in converter.render_all(converter.in_file_order()):
+        converter.output.write(text)
+    #:
+    times["emit"] = time.process_time() - start
+
+    return times, len(order)
+#:
+
+def growth(n0, t0, n1, t1):
+    """ k such that t1 / t0 = (n1 / n0)**k, None unless both times are positive """
+    if t0 <= 0 or t1 <= 0:
+        return None
+    #:
+    return math.log(t1 / t0) / math.log(n1 / n0)
+#:
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Time each stage of q2b on synthetic QIF files")
+    parser.add_argument("--sizes", default="10000,100000,1000000",
+                        help="comma separated numbers of transactions (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per size, the best is kept (default: %(default)s)")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="flag growth faster than n**(1 + TOLERANCE) (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=1, help="qifgen.py random seed (default: %(default)s)")
+    args = parser.parse_args()
+
+    # the conversion messages are not what is measured
+    logging.disable(logging.CRITICAL)
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in [int(size) for size in args.sizes.split(",")]:
+            filename = os.path.join(directory, f"{size}.qif")
+            with open(filename, "w", newline="") as out:
+                qifgen.Generator(args.seed).write(out, size)
+            #:
+            best = None
+            for i in range(args.repeat):
+                times, count = run_stages(filename)
+                best = times if best is None else {stage: min(best[stage], times[stage]) for stage in STAGES}
+            #:
+            results.append((count, best))
+
+            print(f"{count} transactions, {os.path.getsize(filename)} bytes")
+            for stage in STAGES:
+                print(f"  {stage:12} {best[stage]:9.3f} s {best[stage] / count * 1e6:9.1f} us/transaction")
+            #:
+            total = sum(best.values())
+            print(f"  {'total':12} {total:9.3f} s {total / count * 1e6:9.1f} us/transaction")
+            sys.stdout.flush()
+        #:
+    #:
+
+    flagged = False
+    for (n0, small), (n1, large) in zip(results, results[1:]):
+        print(f"growth {n0} -> {n1} transactions")
+        for stage in STAGES:
+            k = growth(n0, small[stage], n1, large[stage])
+            if k is None:
+                continue
+            #:
+            super_linear = k > 1 + args.tolerance and small[stage] >= NOISE
+            flagged = flagged or super_linear
+            print(f"  {stage:12} n**{k:.2f}{'  SUPER-LINEAR' if super_linear else ''}")
+        #:
+    #:
+    sys.exit(1 if flagged else 0)
+#:
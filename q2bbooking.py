@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+
+""" check which lots each booking method sells
+
+usage: q2bbooking.py
+
+Two checks are run for each of FIFO, LIFO, HIFO and AVERAGE:
+
+  lots        q2b.Lots on its own: lots bought at 10, at an unknown cost
+              and at 20, 15 shares sold, a lot bought at 40, 20 shares sold
+  convert     q2b.convert() of a brokerage account buying at 10, 30 and 20
+              and selling 15 then 10 shares at 25: the lots of each sale
+              and the realized gain posted
+
+Every lot removed must be the expected one, with its date, quantity and
+cost; the exit status is 1 if any differ.
+"""
+
+import io
+import re
+import sys
+import decimal
+import logging
+import datetime
+import tempfile
+import q2b
+
+# lots removed by each sale as (day of the lot, quantity, cost to the cent or None)
+LOTS = {
+    "FIFO": [[(1, 10, "10.00"), (2, 5, None)], [(2, 5, None), (3, 10, "20.00"), (4, 5, "40.00")]],
+    "LIFO": [[(3, 10, "20.00"), (2, 5, None)], [(4, 10, "40.00"), (2, 5, None), (1, 5, "10.00")]],
+    "HIFO": [[(3, 10, "20.00"), (1, 5, "10.00")], [(4, 10, "40.00"), (1, 5, "10.00"), (2, 5, None)]],
+    # the lots with a cost are pooled at their average, those without are kept apart
+    "AVERAGE": [[(1, 15, "15.00")], [(1, 15, "31.67"), (2, 5, None)]],
+}
+
+CONVERT_QIF = """!Type:Cat
+N_RlzdGain
+I
+^
+!Option:AutoSwitch
+!Account
+NBroker
+TPort
+^
+!Clear:AutoSwitch
+!Account
+NBroker
+TPort
+^
+!Type:Invst
+D 1/ 1'20
+NBuy
+YAcme
+I10.00
+Q10
+T100.00
+^
+D 1/ 2'20
+NBuy
+YAcme
+I30.00
+Q10
+T300.00
+^
+D 1/ 3'20
+NBuy
+YAcme
+I20.00
+Q10
+T200.00
+^
+D 2/ 1'20
+NSell
+YAcme
+I25.00
+Q15
+T375.00
+^
+D 3/ 1'20
+NSell
+YAcme
+I25.00
+Q10
+T250.00
+^
+"""
+
+# each sale as ([(lot date, quantity, cost)], realized gain posted, None when nil)
+CONVERT = {
+    "FIFO": [([("2020-01-01", "-10", "10.0000000"), ("2020-01-02", "-5", "30.0000000")], "-125.00"),
+             ([("2020-01-02", "-5", "30.0000000"), ("2020-01-03", "-5", "20.0000000")], None)],
+    "LIFO": [([("2020-01-03", "-10", "20.0000000"), ("2020-01-02", "-5", "30.0000000")], "-25.00"),
+             ([("2020-01-02", "-5", "30.0000000"), ("2020-01-01", "-5", "10.0000000")], "-50.00")],
+    "HIFO": [([("2020-01-02", "-10", "30.0000000"), ("2020-01-03", "-5", "20.0000000")], "25.00"),
+             ([("2020-01-03", "-5", "20.0000000"), ("2020-01-01", "-5", "10.0000000")], "-100.00")],
+    "AVERAGE": [([("2020-01-01", "-15", "20.0000000")], "-75.00"),
+                ([("2020-01-01", "-10", "20.0000000")], "-50.00")],
+}
+
+_lot = re.compile(r"Assets:Broker +(-\S+) ACME @ (\S+) CAD ; Lot dated (\S+)")
+_gain = re.compile(r"Income:RlzdGain +(\S+) CAD")
+
+def sales_of_lots(booking):
+    """ the lots removed by the two sales of LOTS """
+
+    converter = q2b.Converter(output=io.StringIO())
+    cad = q2b.Security(converter, "CAD")
+    lots = q2b.Lots(booking)
+
+    def buy(day, cost):
+        lots.add({"security": None, "date": datetime.date(2020, 1, day), "quantity": decimal.Decimal(10),
+                  "cost": q2b.Amount(cost, cad, prec=7) if cost is not None else None})
+    #:
+
+    def sell(quantity):
+        removals, _ = lots.remove(decimal.Decimal(quantity))
+        return [(removal["date"].day, removal["quantity"],
+                 str(removal["cost"].quantity.quantize(q2b.cents)) if removal["cost"] else None)
+                for removal in removals]
+    #:
+
+    buy(1, 10)
+    buy(2, None)
+    buy(3, 20)
+    sales = [sell(15)]
+    buy(4, 40)
+    sales.append(sell(20))
+    return sales
+#:
+
+def sales_of_convert(booking):
+    """ the lots and realized gain of the two sales of CONVERT_QIF """
+
+    with tempfile.NamedTemporaryFile("w", suffix=".qif") as qif:
+        qif.write(CONVERT_QIF)
+        qif.flush()
+        text = q2b.convert(qif.name, {"booking": booking})
+    #:
+    sales = []
+    for entry in text.split("\n\n"):
+        if '* "Sell"' in entry:
+            lots = [(date, quantity, cost) for quantity, cost, date in _lot.findall(entry)]
+            gains = _gain.findall(entry)
+            sales.append((lots, gains[0] if gains else None))
+        #:
+    #:
+    return sales
+#:
+
+if __name__ == "__main__":
+
+    logging.disable(logging.CRITICAL)
+
+    same = True
+    for booking in q2b.Lots.bookings:
+        for name, sales, expected in (("lots", sales_of_lots(booking), LOTS[booking]),
+                                      ("convert", sales_of_convert(booking), CONVERT[booking])):
+            if sales == expected:
+                print(f"{booking:8} {name:8} same")
+            else:
+                print(f"{booking:8} {name:8} DIFFERENT: {sales} instead of {expected}")
+                same = False
+            #:
+        #:
+    #:
+    sys.exit(0 if same else 1)
+#:
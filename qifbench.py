@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+
+""" time qifparser on a QIF file
+
+usage: qifbench.py file.qif [repeat]
+
+Reports the best of `repeat` runs for tokenizing alone, for a parse with
+date and decimal conversion disabled (field dispatch and record building
+only) and for a full parse, and the cost per field (line) of each.
+"""
+
+import sys
+import time
+import qifparser
+
+def tokenize(filename):
+    tokens = qifparser.MmapTokenizer(filename)
+    fields = 0
+    while tokens.line:
+        if tokens.line.startswith("!"):
+            tokens.getline()
+            continue
+        #:
+        chunk = tokens.getchunk()
+        if not chunk and tokens.line and not tokens.line.startswith("!"):
+            tokens.getline()
+        #:
+        fields += len(chunk)
+    #:
+    return fields
+#:
+
+class RawQif(qifparser.Qif):
+    # leave dates and amounts as strings
+
+    def parseDate(self, qdate):
+        return qdate
+    #:
+
+    def parseDecimal(self, s):
+        return s
+    #:
+#:
+
+def parse(filename, qif_class=qifparser.Qif):
+    return qif_class(filename)
+#:
+
+def best_of(repeat, func, *args):
+    best = None
+    for i in range(repeat):
+        start = time.process_time()
+        result = func(*args)
+        elapsed = time.process_time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+        #:
+    #:
+    return best, result
+#:
+
+if __name__ == "__main__":
+
+    filename = sys.argv[1]
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    tokenize_time, fields = best_of(repeat, tokenize, filename)
+    raw_time, _ = best_of(repeat, parse, filename, RawQif)
+    parse_time, qif = best_of(repeat, parse, filename)
+
+    print(f"fields:   {fields}")
+    print(f"tokenize: {tokenize_time:8.3f} s {tokenize_time / fields * 1e9:6.0f} ns/field")
+    print(f"dispatch: {raw_time - tokenize_time:8.3f} s {(raw_time - tokenize_time) / fields * 1e9:6.0f} ns/field")
+    print(f"convert:  {parse_time - raw_time:8.3f} s {(parse_time - raw_time) / fields * 1e9:6.0f} ns/field")
+    print(f"parse:    {parse_time:8.3f} s {parse_time / fields * 1e9:6.0f} ns/field")
+    for name, info in qif.cache_info().items():
+        print(f"{name} cache: {info.hits} hits {info.misses} misses {info.currsize} entries")
+    #:
+#:
@@ -0,0 +1,349 @@
+#!/usr/bin/python3
+
+""" columnar store of parsed QIF transactions
+
+    qif = qifparser.Qif(filename, stream=True)
+    store = qifcolumns.ColumnStore(qif)
+
+The transactions are read straight from qif.iter_records() into typed
+columns, one entry per transaction, available as NumPy arrays:
+
+  date                      int32 proleptic ordinal (0 when absent)
+  account                   int32 index into store.accounts
+  qtype, category, tag,     int32 codes into the symbol table of the same
+  action, security,         name in store.symbols (-1 when absent)
+  payee, memo
+  tAmount, uAmount,         int64 fixed point: value * 10**AMOUNT_SCALE
+  transferAmount,           (NULL when absent)
+  commission
+  price, quantity           int64 fixed point: value * 10**QUANTITY_SCALE
+
+Every fixed point column has an int8 companion "<name>_exp" holding the
+exponent of the original Decimal so that it round-trips exactly.  A value
+with more decimals than the scale keeps them all, being scaled by
+10**-exponent instead; one that does not fit in 64 bits is OUTSIZE in its
+column and kept as a Decimal in store.outsize[(column, row)].
+
+Splits are stored CSR style: the splits of transaction i are rows
+split_offsets[i]:split_offsets[i + 1] of split_category, split_tag,
+split_memo (codes) and split_amount/split_amount_exp.
+
+store[i] returns a TransactionView which reads like a
+qifparser.Transaction and can be handed to q2b.Transaction.  Addresses and
+invoice line items (X? fields) are not kept.  The other records of qif
+(categories, accounts, securities and prices) are kept as they are, and
+store.iter_records() yields them in their order with the transactions as
+views, so that a store can be converted by q2b:
+
+    q2b.convert(store)
+
+NumPy is only needed by this module.
+"""
+
+import sys
+import array
+import decimal
+import datetime
+import qifparser
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+#:
+
+AMOUNT_SCALE = 4
+QUANTITY_SCALE = 8
+
+NULL = -2**63
+OUTSIZE = NULL + 1
+
+AMOUNT_COLUMNS = ("tAmount", "uAmount", "transferAmount", "commission")
+QUANTITY_COLUMNS = ("price", "quantity")
+SYMBOL_COLUMNS = ("qtype", "category", "tag", "action", "security", "payee", "memo")
+
+_exponents = {}
+
+def to_fixed(value, scale):
+    """ (fixed point integer, exponent) for a Decimal or None, OUTSIZE if it does not fit """
+
+    if value is None:
+        return NULL, 0
+    #:
+    exp = value.as_tuple().exponent
+    if not isinstance(exp, int) or not -128 <= exp <= 127:
+        return OUTSIZE, 0
+    #:
+    fixed = int(value.scaleb(max(scale, -exp)))
+    if not OUTSIZE < fixed < 2**63:
+        return OUTSIZE, 0
+    #:
+    return fixed, exp
+#:
+
+def from_fixed(fixed, exp, scale):
+    """ the Decimal to_fixed() was given, not for OUTSIZE """
+
+    if fixed == NULL:
+        return None
+    #:
+    if exp not in _exponents:
+        _exponents[exp] = decimal.Decimal(1).scaleb(exp)
+    #:
+    return decimal.Decimal(fixed).scaleb(-max(scale, -exp)).quantize(_exponents[exp])
+#:
+
+class SymbolTable(object):
+    """ strings <-> dense integer codes """
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+    #:
+
+    def code(self, value):
+        if value is None:
+            return -1
+        #:
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        #:
+        return code
+    #:
+
+    def value(self, code):
+        return self.values[code] if code >= 0 else None
+    #:
+
+    def __len__(self):
+        return len(self.values)
+    #:
+#:
+
+class ColumnStore(object):
+
+    def __init__(self, qif):
+
+        if numpy is None:
+            raise ImportError("qifcolumns needs NumPy")
+        #:
+
+        self.qif = qif
+        self.accounts = []
+        # the other records, each after that many transactions
+        self.records = []
+        self.outsize = {}
+        self.symbols = {name: SymbolTable() for name in SYMBOL_COLUMNS}
+
+        account_codes = {}
+        columns = {"date": array.array("i"), "account": array.array("i")}
+        for name in SYMBOL_COLUMNS:
+            columns[name] = array.array("i")
+        #:
+        for name in AMOUNT_COLUMNS + QUANTITY_COLUMNS:
+            columns[name] = array.array("q")
+            columns[f"{name}_exp"] = array.array("b")
+        #:
+        split_offsets = array.array("q", [0])
+        split_columns = {"split_category": array.array("i"),
+                         "split_tag": array.array("i"),
+                         "split_memo": array.array("i"),
+                         "split_amount": array.array("q"),
+                         "split_amount_exp": array.array("b")}
+
+        for record in qif.iter_records():
+            if not isinstance(record, qifparser.Transaction):
+                self.records.append((len(columns["date"]), record))
+                continue
+            #:
+
+            account = record.account
+            if account.qname not in account_codes:
+                account_codes[account.qname] = len(self.accounts)
+                self.accounts.append(account)
+            #:
+            columns["account"].append(account_codes[account.qname])
+            columns["date"].append(record.date.toordinal() if record.date else 0)
+
+            for name in SYMBOL_COLUMNS:
+                columns[name].append(self.symbols[name].code(getattr(record, name)))
+            #:
+            for names, scale in [(AMOUNT_COLUMNS, AMOUNT_SCALE), (QUANTITY_COLUMNS, QUANTITY_SCALE)]:
+                for name in names:
+                    fixed, exp = to_fixed(getattr(record, name), scale)
+                    if fixed == OUTSIZE:
+                        self.outsize[(name, len(columns[name]))] = getattr(record, name)
+                    #:
+                    columns[name].append(fixed)
+                    columns[f"{name}_exp"].append(exp)
+                #:
+            #:
+
+            for split in record.splits:
+                split_columns["split_category"].append(self.symbols["category"].code(split.category))
+                split_columns["split_tag"].append(self.symbols["tag"].code(split.tag))
+                split_columns["split_memo"].append(self.symbols["memo"].code(split.memo))
+                fixed, exp = to_fixed(split.amount, AMOUNT_SCALE)
+                if fixed == OUTSIZE:
+                    self.outsize[("split_amount", len(split_columns["split_amount"]))] = split.amount
+                #:
+                split_columns["split_amount"].append(fixed)
+                split_columns["split_amount_exp"].append(exp)
+            #:
+            split_offsets.append(len(split_columns["split_amount"]))
+        #:
+
+        columns.update(split_columns)
+        columns["split_offsets"] = split_offsets
+        for name, values in columns.items():
+            setattr(self, name, numpy.frombuffer(values, dtype=values.typecode) if values
+                    else numpy.zeros(0, dtype=values.typecode))
+        #:
+    #:
+
+    def __len__(self):
+        return len(self.date)
+    #:
+
+    def __getitem__(self, i):
+        if not -len(self) <= i < len(self):
+            raise IndexError(i)
+        #:
+        return TransactionView(self, i % len(self))
+    #:
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield TransactionView(self, i)
+        #:
+    #:
+
+    def iter_records(self):
+        """ the records of qif in their order, transactions as TransactionViews """
+
+        i = 0
+        for position, record in self.records:
+            while i < position:
+                yield TransactionView(self, i)
+                i += 1
+            #:
+            yield record
+        #:
+        yield from (TransactionView(self, i) for i in range(i, len(self)))
+    #:
+
+    def amount(self, name):
+        """ a fixed point column as float64, NaN where absent """
+        values = getattr(self, name)
+        scale = QUANTITY_SCALE if name in QUANTITY_COLUMNS else AMOUNT_SCALE
+        result = values / 10.0**numpy.maximum(scale, -getattr(self, f"{name}_exp").astype(numpy.int64))
+        result[values == NULL] = numpy.nan
+        for row in numpy.flatnonzero(values == OUTSIZE):
+            result[row] = float(self.outsize[(name, row)])
+        #:
+        return result
+    #:
+
+    def value(self, name, row, scale):
+        """ the Decimal in fixed point column name at row """
+        fixed = int(getattr(self, name)[row])
+        if fixed == OUTSIZE:
+            return self.outsize[(name, row)]
+        #:
+        return from_fixed(fixed, int(getattr(self, f"{name}_exp")[row]), scale)
+    #:
+
+    def code(self, name, value):
+        """ code of value in symbol table `name`, -1 if never seen """
+        return self.symbols[name].codes.get(value, -1)
+    #:
+#:
+
+class SplitView(object):
+
+    __slots__ = ("store", "row")
+
+    def __init__(self, store, row):
+        self.store = store
+        self.row = row
+    #:
+
+    @property
+    def category(self):
+        return self.store.symbols["category"].value(int(self.store.split_category[self.row]))
+    #:
+
+    @property
+    def tag(self):
+        return self.store.symbols["tag"].value(int(self.store.split_tag[self.row]))
+    #:
+
+    @property
+    def memo(self):
+        return self.store.symbols["memo"].value(int(self.store.split_memo[self.row]))
+    #:
+
+    @property
+    def amount(self):
+        return self.store.value("split_amount", self.row, AMOUNT_SCALE)
+    #:
+#:
+
+class TransactionView(object):
+    """ read-only qifparser.Transaction look-alike for one row """
+
+    __slots__ = ("store", "row")
+
+    def __init__(self, store, row):
+        self.store = store
+        self.row = row
+    #:
+
+    def __getattr__(self, attr):
+        store = self.store
+        if attr in SYMBOL_COLUMNS:
+            return store.symbols[attr].value(int(getattr(store, attr)[self.row]))
+        #:
+        if attr in AMOUNT_COLUMNS or attr in QUANTITY_COLUMNS:
+            scale = QUANTITY_SCALE if attr in QUANTITY_COLUMNS else AMOUNT_SCALE
+            return store.value(attr, self.row, scale)
+        #:
+        raise AttributeError(attr)
+    #:
+
+    @property
+    def account(self):
+        return self.store.accounts[self.store.account[self.row]]
+    #:
+
+    @property
+    def date(self):
+        ordinal = int(self.store.date[self.row])
+        return datetime.datetime.fromordinal(ordinal) if ordinal else None
+    #:
+
+    @property
+    def splits(self):
+        start, end = self.store.split_offsets[self.row:self.row + 2]
+        return [SplitView(self.store, row) for row in range(start, end)]
+    #:
+
+    def __str__(self):
+        fields = ("qtype", "date", "payee", "memo", "category", "action", "security") + AMOUNT_COLUMNS + QUANTITY_COLUMNS
+        return str({name: getattr(self, name) for name in fields if getattr(self, name) is not None})
+    #:
+#:
+
+if __name__ == "__main__":
+
+    store = ColumnStore(qifparser.Qif(sys.argv[1], stream=True))
+
+    print(f"{len(store)} transactions, {len(store.split_category)} splits")
+    amounts = store.amount("tAmount")
+    for code, account in enumerate(store.accounts):
+        mask = store.account == code
+        print(f"{account.qname:30} {mask.sum():8} {numpy.nansum(amounts[mask]):16.2f}")
+    #:
+#:
@@ -0,0 +1,245 @@
+#!/usr/bin/python3
+
+""" write a synthetic all-accounts QIF file
+
+usage: qifgen.py [-s SEED] [-y YEARS] [-o FILE] transactions
+
+The file is laid out the way Quicken 2015 exports all accounts: tags,
+categories, the account list, each account's transactions in date order,
+the securities and their price history.  It has a chequing and a credit
+card account in CAD, a savings account in USD and a brokerage account in
+each currency, with about `transactions` transactions spread over YEARS
+years:
+
+  purchases, some tagged, and purchases split between categories
+  salary deposits
+  credit card payments and CAD -> USD transfers at the exchange rate of the day
+  buys and sells, with and without a cash transfer from or to chequing
+  dividends, reinvested dividends (DRIP lots) and interest
+  shares transferred in and stock splits
+
+Sells never exceed the shares held.  The same arguments always give the
+same file.
+"""
+
+import sys
+import random
+import datetime
+import tempfile
+import shutil
+import argparse
+
+CATEGORIES = [("Groceries", "E"), ("Auto:Fuel", "E"), ("Utilities:Hydro", "E"), ("Dining", "E"),
+              ("Salary", "I"), ("_DivInc", "I"), ("_IntInc", "I"), ("_RlzdGain", "I"), ("_IntExp", "E")]
+EXPENSES = ["Groceries", "Auto:Fuel", "Utilities:Hydro", "Dining"]
+
+# name, type, description (the currency between <>), securities traded
+ACCOUNTS = [("Chequing", "Bank", "Main account", None),
+            ("Visa", "CCard", "", None),
+            ("US Savings", "Bank", "Savings <USD>", None),
+            ("Broker", "Port", "Brokerage", ["Acme Corp", "Big Fund Series A", "Widget Inc"]),
+            ("US Broker", "Port", "US brokerage <USD>", ["Globex Corp", "Initech"])]
+
+# name, symbol, first price
+SECURITIES = [("Acme Corp", "ACM", 12.50), ("Big Fund Series A", "BFA", 10.00), ("Widget Inc", "WID", 40.00),
+              ("Globex Corp", "GBX", 55.00), ("Initech", "INI", 20.00)]
+
+def qif_date(date):
+    """ date as Quicken 2015 writes it """
+
+    if date.year < 2000:
+        return f"{date.month:>2}/{date.day:>2}/{date.year % 100:02}"
+    #:
+    return f"{date.month:>2}/{date.day:>2}'{date.year % 100:02}"
+#:
+
+def money(amount):
+    return f"{amount:,.2f}"
+#:
+
+class Generator(object):
+
+    def __init__(self, seed=1, years=10, start=datetime.date(1997, 1, 1)):
+
+        self.random = random.Random(seed)
+        self.start = start
+        self.days = 365 * years
+        self.prices = {name: price for name, symbol, price in SECURITIES}
+        self.quotes = []
+        self.held = {name: {} for name, _, _, _ in ACCOUNTS}
+        self.rate = 1.35
+        # transactions of each account, spooled to disk until written
+        self.files = {name: tempfile.TemporaryFile("w+", newline="") for name, _, _, _ in ACCOUNTS}
+    #:
+
+    def add(self, account, date, *fields):
+        self.files[account].write("\r\n".join((f"D{qif_date(date)}",) + fields + ("^", "")))
+    #:
+
+    def write(self, out, transactions):
+        """ write a file of about that many transactions to out """
+
+        count = 0
+        day = -1
+        while count < transactions:
+            # the prices move and are quoted every month
+            while day < count * self.days // transactions:
+                day += 1
+                self.next_day(self.start + datetime.timedelta(days=day))
+            #:
+            count += self.transaction(self.start + datetime.timedelta(days=day))
+        #:
+
+        lines = ["!Type:Tag", "NVacation", "^", "!Type:Cat"]
+        for name, kind in CATEGORIES:
+            lines.extend([f"N{name}", "DSome description", kind, "^"])
+        #:
+        lines.extend(["!Option:AutoSwitch", "!Account"])
+        for name, qtype, description, _ in ACCOUNTS:
+            lines.extend([f"N{name}", f"T{qtype}"] + ([f"D{description}"] if description else []) + ["^"])
+        #:
+        lines.append("!Clear:AutoSwitch")
+        out.write("\r\n".join(lines + [""]))
+
+        for name, qtype, description, _ in ACCOUNTS:
+            lines = ["!Account", f"N{name}", f"T{qtype}"] + ([f"D{description}"] if description else []) + ["^"]
+            lines.append("!Type:Invst" if qtype == "Port" else f"!Type:{qtype}")
+            out.write("\r\n".join(lines + [""]))
+            self.files[name].seek(0)
+            shutil.copyfileobj(self.files[name], out)
+            self.files[name].close()
+        #:
+
+        lines = ["!Type:Security"]
+        for name, symbol, _ in SECURITIES:
+            lines.extend([f"N{name}", f"S{symbol}", "TStock", "^"])
+        #:
+        lines.append("!Type:Prices")
+        for symbol, price, date in self.quotes:
+            lines.extend([f'"{symbol}",{price:.2f},"{qif_date(date)}"', "^"])
+        #:
+        out.write("\r\n".join(lines + [""]))
+    #:
+
+    def next_day(self, date):
+
+        r = self.random
+        for name in self.prices:
+            self.prices[name] = max(1.0, self.prices[name] * (1 + r.gauss(0.0002, 0.01)))
+        #:
+        self.rate = min(1.6, max(1.0, self.rate * (1 + r.gauss(0, 0.003))))
+        if date.day == 1:
+            for name, symbol, _ in SECURITIES:
+                self.quotes.append((symbol, self.prices[name], date))
+            #:
+        #:
+    #:
+
+    def transaction(self, date):
+        """ add a transaction dated date, the number of records added """
+
+        r = self.random
+        amount = r.randrange(100, 30000) / 100
+        kind = r.random()
+
+        if kind < 0.30:
+            account = r.choice(["Chequing", "Chequing", "Visa", "US Savings"])
+            category = r.choice(EXPENSES) + ("/Vacation" if r.random() < 0.1 else "")
+            self.add(account, date, f"T-{money(amount)}", "Cx", f"PStore {r.randrange(200)}",
+                     f"L{category}", 'MMemo "quoted"')
+            return 1
+        elif kind < 0.38:
+            first, second = r.randrange(100, 8000) / 100, r.randrange(100, 8000) / 100
+            self.add("Chequing", date, f"T-{money(first + second)}", "PSplit shop",
+                     f"S{r.choice(EXPENSES)}", "Efirst", f"$-{money(first)}",
+                     "SDining/Vacation", f"$-{money(second)}")
+            return 1
+        elif kind < 0.46:
+            self.add("Chequing", date, f"T-{money(amount)}", "L[Visa]", "PPayment")
+            self.add("Visa", date, f"T{money(amount)}", "L[Chequing]", "PPayment")
+            return 2
+        elif kind < 0.50:
+            self.add("Chequing", date, f"T-{money(amount)}", "L[US Savings]", "PExchange")
+            self.add("US Savings", date, f"T{money(amount / self.rate)}", "L[Chequing]", "PExchange")
+            return 2
+        elif kind < 0.56:
+            self.add("Chequing", date, f"T{money(amount * 10)}", "LSalary", "PEmployer")
+            return 1
+        #:
+        return self.investment(date, r.choice(["Broker", "Broker", "US Broker"]))
+    #:
+
+    def investment(self, date, account):
+
+        r = self.random
+        security = r.choice(ACCOUNTS[[name for name, _, _, _ in ACCOUNTS].index(account)][3])
+        price = round(self.prices[security], 2)
+        held = self.held[account].get(security, 0)
+        action = r.random()
+
+        if action < 0.30 or (action < 0.55 and held < 4):
+            quantity = r.randrange(1, 200)
+            self.held[account][security] = held + quantity
+            self.add(account, date, "NBuy", f"Y{security}", f"I{price:.2f}", f"Q{quantity}",
+                     f"T{money(quantity * price + 9.99)}", "O9.99")
+            return 1
+        elif action < 0.40 and account == "Broker":
+            quantity = r.randrange(1, 200)
+            self.held[account][security] = held + quantity
+            self.add(account, date, "NBuyX", f"Y{security}", f"I{price:.2f}", f"Q{quantity}",
+                     f"T{money(quantity * price)}", "L[Chequing]", f"${money(quantity * price)}")
+            self.add("Chequing", date, f"T-{money(quantity * price)}", "L[Broker]", "PBuy")
+            return 2
+        elif action < 0.55:
+            quantity = r.randrange(1, int(held // 4) + 1)
+            self.held[account][security] = held - quantity
+            if account == "Broker" and r.random() < 0.5:
+                self.add(account, date, "NSellX", f"Y{security}", f"I{price:.2f}", f"Q{quantity}",
+                         f"T{money(quantity * price)}", "L[Chequing]", f"${money(quantity * price)}")
+                self.add("Chequing", date, f"T{money(quantity * price)}", "L[Broker]", "PSell")
+                return 2
+            #:
+            self.add(account, date, "NSell", f"Y{security}", f"I{price:.2f}", f"Q{quantity}",
+                     f"T{money(quantity * price - 9.99)}", "O9.99")
+            return 1
+        elif action < 0.70 and held:
+            self.add(account, date, "NDiv", f"Y{security}", f"T{money(held * price * 0.005)}")
+            return 1
+        elif action < 0.85 and held:
+            # dividend reinvested: a new lot of a few shares
+            quantity = round(held * 0.005 + 0.001, 3)
+            self.held[account][security] = held + quantity
+            self.add(account, date, "NReinvDiv", f"Y{security}", f"I{price:.2f}", f"Q{quantity:.3f}",
+                     f"T{money(quantity * price)}")
+            return 1
+        elif action < 0.95:
+            self.add(account, date, "NIntInc", f"T{money(r.randrange(100, 5000) / 100)}")
+            return 1
+        elif action < 0.98 or not held or price < 60:
+            quantity = r.randrange(1, 100)
+            self.held[account][security] = held + quantity
+            self.add(account, date, "NShrsIn", f"Y{security}", f"I{price:.2f}", f"Q{quantity}",
+                     f"T{money(quantity * price)}")
+            return 1
+        #:
+        # 2 for 1, as companies do once their shares trade high
+        self.held[account][security] = held * 2
+        self.prices[security] /= 2
+        self.add(account, date, "NStkSplit", f"Y{security}", "Q20")
+        return 1
+    #:
+#:
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Write a synthetic all-accounts QIF file")
+    parser.add_argument("transactions", type=int, help="about how many transactions to write")
+    parser.add_argument("-s", "--seed", type=int, default=1, help="random seed (default: %(default)s)")
+    parser.add_argument("-y", "--years", type=int, default=10, help="years of transactions (default: %(default)s)")
+    parser.add_argument("-o", "--output", help="write to OUTPUT instead of stdout")
+    args = parser.parse_args()
+
+    out = open(args.output, "w", newline="") if args.output else sys.stdout
+    Generator(args.seed, args.years).write(out, args.transactions)
+    out.close()
+#:
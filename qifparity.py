@@ -0,0 +1,189 @@
+#!/usr/bin/python3
+
+""" check that every way qifparser reads a QIF file gives the same result
+
+usage: qifparity.py [-n TRANSACTIONS] [-s SEED]
+
+Two files are read: one written by qifgen.py, and a small hand-made one
+with the awkward parts of real exports (mixed CR, LF and CR LF line ends,
+bytes that do not decode, empty records, blank lines, bad values and
+sections that are skipped).  A Qif over a TextTokenizer, which reads the
+file line by line, is the reference; each file is then read
+
+  mmap          as by default, through MmapTokenizer
+  stream        through StreamTokenizer
+  mmap:N        through MmapTokenizer and StreamTokenizer decoding blocks
+  stream:N      of N bytes, so that lines and CR LF pairs straddle blocks
+  jobs          with jobs=2 and parts of 64 bytes
+  gz, bz2, xz   compressed
+  cache         twice with a parse cache, writing then replaying it
+
+Every field of every record, the accounts of transactions by name, and
+the messages written must be the same as for the reference (a replayed
+cache writes no messages).  The exit status is 1 if any differ.
+"""
+
+import io
+import os
+import sys
+import gzip
+import bz2
+import lzma
+import decimal
+import locale
+import tempfile
+import argparse
+import qifparser
+import qifgen
+
+BLOCK_SIZES = (1, 7, 64, 4096)
+
+# the edge cases, repeated so that a parallel parse has several parts; an
+# empty record ends record mode for the rest of its section, so empty
+# records come at the end of sections
+EDGES = [
+    b"junk before the first header\r\n",
+    b"!Type:Tag\r\nNVacation\r\n^\r\n",
+    b"!Type:Cat\nNGroceries\nDFood \xff\xfe and drink\nE\n^\r",
+    b"NSalary\rI\r^\r\n\r\n   \r\n",
+    b"!Option:AutoSwitch\r\n!Account\r\nNChequing\r\nTBank\r\n^\r\nNBroker\r\nTPort\r\n^\r\n!Clear:AutoSwitch\r\n",
+    b"!Type:Template\r\nD 1/ 1'20\r\nT-1.00\r\n^\r\n",
+    b"!Type:Memorized\r\nKC\r\nT-1.00\r\nPRent\r\n^\r\n",
+    b"!Account\r\nNChequing\r\nTBank\r\n^\r\n!Type:Bank\r\n",
+] + [
+    b"D 1/%2d'20\r\nT-1%d.00\r\nPStore \xe9t\xc3\xa9\r\nLGroceries\r\n^\r\n"
+    b"\r\n  \r\n"
+    b"D 2/%2d'20\rT-1,2%d.56\rMcaf\xc3\xa9 \x80\rSGroceries\r$-1.00\rSDining/Vacation\r$-2.00\r^\n"
+    b"D 3/%2d'20\nTabc\nPBad amount\n^\r\n" % (day, day, day, day, day)
+    for day in range(1, 29)
+] + [
+    b"^\r\nD 4/ 1'20\r\nT-1.00\r\n^\r\n",
+    b"!Account\r\nNBroker\r\nTPort\r\n^\r\n!Type:Invst\r\n",
+] + [
+    b"D 4/%2d'20\r\nNBuy\r\nYAcme\r\nI5.00\r\nQ%d\r\nT50.00\r\nO\r\n^\r\n"
+    b"D 5/%2d'20\nNShrsIn\nYAcme\nQ1\n^\n" % (day, day, day)
+    for day in range(1, 29)
+] + [
+    b"^\n",
+    b"!Type:Security\r\nNAcme\r\nSACM\r\nTStock\r\n^\r\n",
+    b"!Type:Prices\r\n\"ACM\",5.25,\" 6/ 1'20\"\r\n^\r\n\"ACM\",bad,\" 6/ 2'20\"\r\n^",
+]
+
+def state(value):
+    """ value with its records as tuples of their fields and accounts as their names """
+
+    if isinstance(value, qifparser.Account):
+        return ("Account", value.qname, value.description, value.l, value.r, value.type)
+    elif isinstance(value, qifparser.Base):
+        return (type(value).__name__,) + tuple(
+            value.account.qname if name == "account" and value.account is not None else state(getattr(value, name))
+            for name in value.__slots__)
+    elif isinstance(value, (list, tuple)):
+        return tuple(state(item) for item in value)
+    elif isinstance(value, decimal.Decimal):
+        # equal Decimals can still differ in exponent
+        return ("Decimal", str(value))
+    #:
+    return value
+#:
+
+def read(filename, tokens=None, **options):
+    """ (records, messages) of Qif(filename, stream=True), over tokens if given
+
+    Options that are not Qif arguments, such as part_size, are set on the Qif.
+    """
+
+    messages = io.StringIO()
+    arguments = {name: options.pop(name) for name in ("cache", "jobs") if name in options}
+    qif = qifparser.Qif(filename, stream=True, messages=messages, **arguments)
+    if tokens is not None:
+        qif.reset(tokens, messages)
+    #:
+    for name, value in options.items():
+        setattr(qif, name, value)
+    #:
+    return [state(record) for record in qif.iter_records()], messages.getvalue()
+#:
+
+def block_tokenizer(base, size):
+    return type(f"{base.__name__}{size}", (base,), {"block_size": size})
+#:
+
+def reads(filename, directory):
+    """ (name, records and messages) of each way of reading filename """
+
+    encoding = locale.getpreferredencoding(False)
+    yield "mmap", read(filename)
+    yield "stream", read(filename, qifparser.StreamTokenizer(open(filename, "rb"), encoding))
+    for size in BLOCK_SIZES:
+        yield f"mmap:{size}", read(filename, block_tokenizer(qifparser.MmapTokenizer, size)(filename, encoding))
+        yield f"stream:{size}", read(filename, block_tokenizer(qifparser.StreamTokenizer, size)(open(filename, "rb"),
+                                                                                                 encoding))
+    #:
+    yield "jobs", read(filename, jobs=2, part_size=64)
+
+    base = os.path.join(directory, os.path.basename(filename))
+    for name, module in (("gz", gzip), ("bz2", bz2), ("xz", lzma)):
+        with open(filename, "rb") as fh, module.open(f"{base}.{name}", "wb") as out:
+            out.write(fh.read())
+        #:
+        yield name, read(f"{base}.{name}")
+    #:
+
+    cache = f"{base}.cache"
+    yield "cache:write", read(filename, cache=cache)
+    yield "cache:replay", read(filename, cache=cache)
+#:
+
+def first_difference(records, expected):
+    for i, (record, reference) in enumerate(zip(records, expected)):
+        if record != reference:
+            return f"record {i}: {record} instead of {reference}"
+        #:
+    #:
+    return f"{len(records)} records instead of {len(expected)}"
+#:
+
+def check(filename, directory):
+    """ whether every way of reading filename gives what the reference does """
+
+    encoding = locale.getpreferredencoding(False)
+    reference = read(filename, qifparser.TextTokenizer(open(filename, encoding=encoding)))
+    print(f"{filename}: {len(reference[0])} records, {reference[1].count(chr(10))} message lines")
+
+    same = True
+    for name, (records, messages) in reads(filename, directory):
+        if records != reference[0]:
+            print(f"  {name:12} DIFFERENT RECORDS, {first_difference(records, reference[0])}")
+            same = False
+        elif messages != ("" if name == "cache:replay" else reference[1]):
+            print(f"  {name:12} DIFFERENT MESSAGES:\n{messages}")
+            same = False
+        else:
+            print(f"  {name:12} same")
+        #:
+    #:
+    return same
+#:
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Check that every way qifparser reads a QIF file gives the same result")
+    parser.add_argument("-n", "--transactions", type=int, default=5000,
+                        help="transactions of the qifgen.py file (default: %(default)s)")
+    parser.add_argument("-s", "--seed", type=int, default=1, help="qifgen.py random seed (default: %(default)s)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        generated = os.path.join(directory, "generated.qif")
+        with open(generated, "w", newline="") as out:
+            qifgen.Generator(args.seed).write(out, args.transactions)
+        #:
+        edges = os.path.join(directory, "edges.qif")
+        with open(edges, "wb") as out:
+            out.write(b"".join(EDGES))
+        #:
+        same = [check(filename, directory) for filename in (generated, edges)]
+    #:
+    sys.exit(0 if all(same) else 1)
+#:
@@ -1,27 +1,71 @@
 #!/usr/bin/python3
 
+import os
 import sys
+import re
+import gc
+import io
+import mmap
+import locale
+import operator
 import pprint
 import decimal
 import datetime
+import functools
+import concurrent.futures
+import hashlib
+import pickle
+import json
 import pprint
+import csv
+import queue
+import threading
+import zlib
+
+try:
+    import bz2
+except ImportError:
+    bz2 = None
+#:
+try:
+    import lzma
+except ImportError:
+    lzma = None
+#:
 
 class Base(object):
+    """ QIF record with a fixed set of fields, None when absent """
+
+    __slots__ = ()
 
     def __str__(self):
-        return pprint.pformat(self.__dict__)
+        return pprint.pformat({name: getattr(self, name) for name in self.__slots__
+                               if getattr(self, name) is not None})
     #:
 
-    def __getattr__(self, attr):
-        # called only when attr does not already exist
-        return None
+    def __reduce__(self):
+        # pickle only the fields that are set, __init__ supplies the rest
+        state = {}
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if value is not None and value != ():
+                state[name] = value
+            #:
+        #:
+        return (type(self), (), (None, state))
     #:
 #:
 
 class Account(Base):
 
+    __slots__ = ("qname", "description", "l", "r", "type", "transactions")
+
     def __init__(self):
         self.qname = None
+        self.description = None
+        self.l = None
+        self.r = None
+        self.type = None
         self.transactions = []
     #:
 
@@ -31,326 +75,1498 @@ class Account(Base):
 #:
 
 class Split(Base):
-    pass
+    # also used for the X? invoice line items
+
+    __slots__ = ("category", "tag", "memo", "amount",
+                 "taxable", "description", "quantity", "price")
+
+    def __init__(self):
+        self.category = None
+        self.tag = None
+        self.memo = None
+        self.amount = None
+        self.taxable = None
+        self.description = None
+        self.quantity = None
+        self.price = None
+    #:
+#:
 
 class Security(Base):
+
+    __slots__ = ("qname", "g", "symbol", "type")
+
+    def __init__(self):
+        self.qname = None
+        self.g = None
+        self.symbol = None
+        self.type = None
+    #:
+
     def __repr__(self):
         return self.qname
     #:
 #:
 
+class Price(Base):
+    # one quote from a !Type:Prices section; security is the symbol or,
+    # for securities without one, the name
+
+    __slots__ = ("security", "price", "date")
+
+    def __init__(self):
+        self.security = None
+        self.price = None
+        self.date = None
+    #:
+#:
+
 class Category(Base):
-    pass
+
+    __slots__ = ("qname", "budget", "description", "e", "income", "taxSchedule", "taxRelated")
+
+    def __init__(self):
+        self.qname = None
+        self.budget = None
+        self.description = None
+        self.e = None
+        self.income = None
+        self.taxSchedule = None
+        self.taxRelated = None
+    #:
+#:
 
 class Transaction(Base):
 
+    __slots__ = ("qtype", "account", "date", "cleared", "k", "payee", "memo", "address",
+                 "category", "tag", "splits", "action", "security", "price", "quantity",
+                 "commission", "tAmount", "uAmount", "transferAmount", "transactionType",
+                 "dueDate", "lineItemP", "taxRate", "taxAmount", "lines")
+
     def __init__(self):
-        self.splits = []
-        self.address = []
-        self.lines= []
+        self.qtype = None
+        self.account = None
+        self.date = None
+        self.cleared = None
+        self.k = None
+        self.payee = None
+        self.memo = None
+        self.address = ()
+        self.category = None
+        self.tag = None
+        self.splits = ()
+        self.action = None
+        self.security = None
+        self.price = None
+        self.quantity = None
+        self.commission = None
+        self.tAmount = None
+        self.uAmount = None
+        self.transferAmount = None
+        self.transactionType = None
+        self.dueDate = None
+        self.lineItemP = None
+        self.taxRate = None
+        self.taxAmount = None
+        self.lines = ()
     #:
     
     def addSplit(self, field, value):
-        if (not self.splits) or (getattr(self.splits[-1], field) is not None):
+        if not self.splits:
+            self.splits = [Split()]
+        elif getattr(self.splits[-1], field) is not None:
             self.splits.append(Split())
         #:
         setattr(self.splits[-1], field, value)
     #:
 
     def addLine(self, field, value):
-        if (not self.lines) or hasattr(self.lines[-1], field):
+        if not self.lines:
+            self.lines = [Split()]
+        elif hasattr(self.lines[-1], field):
             self.lines.append(Split())
         #:
         setattr(self.lines[-1], field, value)
     #:
 #:
 
-class Qif(object):
+# A line whose first non-blank character is "^" ends a record and one
+# starting with "!" ends a section.
 
-    def __init__(self, filename=None):
+_BOUNDARY = re.compile(r"[\^!]")
+_NEWLINE = re.compile(rb"[\r\n]")
+_FRACTION = re.compile(r"(?:(\d+) +)?(\d+)/(\d+)", re.A)
+_TEXT_SECTION_START = re.compile(r"^\s*!", re.M)
 
-        if filename:
-            self.fh = open(filename)
-        else:
-            self.fh = sys.stdin
+# what str.strip() removes from an ASCII line
+_ASCII_BLANKS = b" \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f"
+
+# Fast paths for the common QIF date forms: (pattern, century).  Month and
+# day are one or two digits, a leading blank counting as "0"; a day before
+# "'" always has two.  Anything else goes through Qif.decodeDateSlow().
+
+_DATE_FORMATS = [
+    (re.compile(r"(\d| \d|\d\d)/(\d| \d|\d\d)/(\d\d)", re.A), 1900),   # 7/ 9/98
+    (re.compile(r"(\d| \d|\d\d)/( \d|\d\d)'(\d\d)", re.A), 2000),       # 10/10'01
+    (re.compile(r"(\d| \d|\d\d)/(\d| \d|\d\d)/(\d{4})", re.A), 0),      # 01/22/2002
+    (re.compile(r"(\d| \d|\d\d)/( \d|\d\d)'(\d{4})", re.A), 0),
+    ]
+
+class Tokenizer(object):
+    """ splits QIF input into stripped, non-blank lines
+
+    self.line is the current line ("" at end of input).  Subclasses
+    provide getline(); getchunk() and skip_section() work line by line.
+    """
+
+    def getchunk(self):
+        chunk = []
+        while self.line and (self.line[0] not in ["^", "!"]):
+            chunk.append(self.line)
+            self.getline()
+        #:
+        if self.line.startswith("^"):
+            self.getline()
         #:
-        self.fh.reconfigure(errors="ignore")
 
-        self.lastAccount = None
-        self.accounts = {}
-        self.categories = {}
-        self.securities = {}
-        
-        self.getline()
+        return chunk
+    #:
 
-        while self.inputLine:
-            self.process_section()
+    def skip_section(self):
+        while self.line and not self.line.startswith("!"):
+            self.getline()
         #:
     #:
+#:
+
+class TextTokenizer(Tokenizer):
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.fh.reconfigure(errors="ignore")
+        self.getline()
+    #:
 
-        
     def getline(self):
         # skip blank input lines
         while True:
-            self.inputLine = self.fh.readline()
-            if not self.inputLine:
+            self.line = self.fh.readline()
+            if not self.line:
                 return
             #:
-            self.inputLine = self.inputLine.rstrip('\r\n').strip()
-            if self.inputLine:
+            self.line = self.line.rstrip('\r\n').strip()
+            if self.line:
                 return
             #:
         #:
     #:
+#:
+
+class BlockTokenizer(Tokenizer):
+    """ tokenizer over blocks of bytes
+
+    The input is decoded a block at a time and split into lines in bulk;
+    record and section boundaries are then found by searching a string
+    made of the first character of every line.  Subclasses provide fill(),
+    which appends the lines of the next block with add_lines(), and more(),
+    whether any input is left for it.
+    """
+
+    block_size = 1 << 22
+
+    def decode(self, data):
+        # same newline translation as a text mode file; a "\r" left before
+        # a "\n" is removed when the line is stripped
+        text = data.decode(self.encoding, "ignore")
+        if text.count("\r") != text.count("\r\n"):
+            text = text.replace("\r\n", "\n").replace("\r", "\n")
+        #:
+        return text
+    #:
+
+    def add_lines(self, text):
+        # append the non-blank lines of text to the unread lines
+        lines = list(filter(None, map(str.strip, text.split("\n"))))
+        if lines:
+            self.lines = self.lines[self.i:] + lines
+            self.firsts = self.firsts[self.i:] + "".join(map(operator.itemgetter(0), lines))
+            self.i = 0
+        #:
+        return bool(lines)
+    #:
+
+    def skip_ahead(self):
+        # called by skip_section() when everything buffered is skipped
+        pass
+    #:
+
+    def getline(self):
+        self.i += 1
+        if self.i >= len(self.lines):
+            self.fill()
+        #:
+        self.line = self.lines[self.i] if self.i < len(self.lines) else ""
+    #:
 
     def getchunk(self):
-        chunk = []
-        while self.inputLine and (self.inputLine[0] not in ["^", "!"]):
-            chunk.append(self.inputLine)
-            self.getline()
+        if not self.line or self.line[0] in "^!":
+            return Tokenizer.getchunk(self)
+        #:
+
+        m = _BOUNDARY.search(self.firsts, self.i)
+        while not m and self.more():
+            self.fill()
+            m = _BOUNDARY.search(self.firsts, self.i)
         #:
-        if self.inputLine.startswith("^"):
+        end = m.start() if m else len(self.lines)
+
+        chunk = self.lines[self.i:end]
+        if end + 1 < len(self.lines) and self.firsts[end] == "^":
+            # common case: step over the "^" without leaving the buffer
+            self.i = end + 1
+            self.line = self.lines[self.i]
+            return chunk
+        #:
+        self.i = end - 1
+        self.getline()
+        if self.line.startswith("^"):
             self.getline()
         #:
 
         return chunk
     #:
 
-    
+    def skip_section(self):
+        if not self.line or self.line.startswith("!"):
+            return
+        #:
+
+        end = self.firsts.find("!", self.i)
+        while end < 0 and self.more():
+            # everything left in the buffer belongs to the skipped section
+            self.lines = self.lines[:self.i]
+            self.firsts = self.firsts[:self.i]
+            self.skip_ahead()
+            self.fill()
+            end = self.firsts.find("!", self.i)
+        #:
+        if end < 0:
+            end = len(self.lines)
+        #:
+
+        self.i = end - 1
+        self.getline()
+    #:
+#:
+
+class MmapTokenizer(BlockTokenizer):
+    """ tokenizer over a memory-mapped file
+
+    Skipped sections are stepped over in bytes without being decoded.
+    Lines are identical to those TextTokenizer would produce from
+    open(filename).
+    """
+
+    def __init__(self, filename, encoding=None, start=0, end=None):
+        self.fh = open(filename, "rb")
+        try:
+            self.data = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty files cannot be mapped
+            self.data = b""
+        #:
+        self.encoding = encoding or locale.getpreferredencoding(False)
+        self.seek(start, end)
+    #:
+
+    def seek(self, start, end=None):
+        """ tokenize bytes start:end of the file (start must begin a line) """
+        self.pos = start
+        self.size = len(self.data) if end is None else end
+        self.lines = []
+        self.firsts = ""
+        self.i = -1
+        self.getline()
+    #:
+
+    def more(self):
+        return self.pos < self.size
+    #:
+
+    def skip_ahead(self):
+        self.pos = self.find_section(self.pos)
+    #:
+
+    def fill(self):
+        # append the lines of the next block to the unread lines
+        while self.pos < self.size:
+            end = min(self.pos + self.block_size, self.size)
+            if end < self.size:
+                # break after a line end; a "\r\n" cut in two only adds a blank line
+                cut = max(self.data.rfind(b"\n", self.pos, end), self.data.rfind(b"\r", self.pos, end))
+                if cut >= 0:
+                    end = cut + 1
+                else:
+                    m = _NEWLINE.search(self.data, end, self.size)
+                    end = m.end() if m else self.size
+                #:
+            #:
+            text = self.decode(self.data[self.pos:end])
+            self.pos = end
+            if self.add_lines(text):
+                return
+            #:
+        #:
+    #:
+
+    def find_section(self, pos):
+        """ offset of the next line starting with "!", without decoding
+
+        If the bytes skipped over are not all ASCII the header might hide
+        behind a non-ASCII blank; pos is returned so that fill() decodes
+        the region instead.
+        """
+        start = pos
+        while True:
+            bang = self.data.find(b"!", pos, self.size)
+            if bang < 0:
+                bang = self.size
+                break
+            #:
+            bol = max(self.data.rfind(b"\n", start, bang), self.data.rfind(b"\r", start, bang), start - 1) + 1
+            if not self.data[bol:bang].strip(_ASCII_BLANKS):
+                bang = bol
+                break
+            #:
+            pos = bang + 1
+        #:
+
+        region = self.data[start:bang]
+        if not region.isascii() and _TEXT_SECTION_START.search(self.decode(region)):
+            return start
+        #:
+        return bang
+    #:
+
+    def section_offsets(self, start=0):
+        """ offsets of the lines starting with "!" in bytes start:size
+
+        None when a header may hide behind a non-ASCII blank and the
+        offsets cannot be trusted without decoding.
+        """
+        offsets = []
+        pos = start
+        while pos < self.size:
+            start = self.find_section(pos)
+            if start >= self.size:
+                break
+            #:
+            bang = self.data.find(b"!", start, self.size)
+            if bang < 0 or self.data[start:bang].strip(_ASCII_BLANKS):
+                return None
+            #:
+            offsets.append(start)
+            pos = bang + 1
+        #:
+        return offsets
+    #:
+
+    def header(self, start, end):
+        """ the first line of bytes start:end as getline() would give it """
+        m = _NEWLINE.search(self.data, start, end)
+        return self.decode(self.data[start:m.start() if m else end]).strip()
+    #:
+
+    def record_end(self, pos, end):
+        """ offset just past the first "^" line starting after pos, or end
+
+        Only lines whose blanks before the "^" are ASCII are considered.
+        """
+        m = _NEWLINE.search(self.data, pos, end)
+        if not m:
+            return end
+        #:
+        pos = m.end()
+        while True:
+            caret = self.data.find(b"^", pos, end)
+            if caret < 0:
+                return end
+            #:
+            bol = max(self.data.rfind(b"\n", pos, caret), self.data.rfind(b"\r", pos, caret), pos - 1) + 1
+            m = _NEWLINE.search(self.data, caret, end)
+            if not m:
+                return end
+            #:
+            if not self.data[bol:caret].strip(_ASCII_BLANKS):
+                if self.data[m.start():m.end() + 1] == b"\r\n":
+                    return m.end() + 1
+                #:
+                return m.end()
+            #:
+            pos = m.end()
+        #:
+    #:
+#:
+
+# magic bytes of the compressed formats that are read transparently
+_COMPRESSION = [(b"\x1f\x8b", "gzip"), (b"BZh", "bz2"), (b"\xfd7zXZ\x00", "xz")]
+
+def compression(head):
+    """ the compression format of a file starting with bytes head, or None """
+    for magic, kind in _COMPRESSION:
+        if head.startswith(magic):
+            return kind
+        #:
+    #:
+    return None
+#:
+
+def decompressor(kind):
+    """ a decompressor object for one stream of a compression format """
+    if kind == "gzip":
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    #:
+    module = bz2 if kind == "bz2" else lzma
+    if module is None:
+        raise ImportError(f"This Python cannot decompress {kind} input")
+    #:
+    return module.BZ2Decompressor() if kind == "bz2" else module.LZMADecompressor()
+#:
+
+class StreamTokenizer(BlockTokenizer):
+    """ tokenizer over a binary stream, decompressed if need be
+
+    gzip, bz2 and xz input is recognized by its magic bytes.  A background
+    thread reads (and decompresses) up to read_ahead blocks ahead of the
+    tokenizer, so that decompression and tokenizing overlap.
+    """
+
+    read_ahead = 4
+
+    def __init__(self, fh, encoding=None):
+        self.fh = fh
+        self.encoding = encoding or locale.getpreferredencoding(False)
+        self.rest = b""
+        self.eof = False
+        self.lines = []
+        self.firsts = ""
+        self.i = -1
+
+        self.blocks = queue.Queue(self.read_ahead)
+        self.reader = threading.Thread(target=self.read, daemon=True)
+        self.reader.start()
+        self.getline()
+    #:
+
+    def read(self):
+        # reader thread: queues blocks of bytes, then b"" at the end of the
+        # input or the exception that stopped it
+        try:
+            for block in self.read_blocks():
+                self.blocks.put(block)
+            #:
+            self.blocks.put(b"")
+        except Exception as e:
+            self.blocks.put(e)
+        #:
+    #:
+
+    def read_blocks(self):
+        data = self.fh.read(self.block_size)
+        kind = compression(data)
+        if kind is None:
+            while data:
+                yield data
+                data = self.fh.read(self.block_size)
+            #:
+            return
+        #:
+
+        unpacker, fed = decompressor(kind), False
+        while True:
+            if not data:
+                data = self.fh.read(self.block_size)
+                if not data:
+                    break
+                #:
+            #:
+            fed = True
+            block = unpacker.decompress(data)
+            data = b""
+            if block:
+                yield block
+            #:
+            if unpacker.eof:
+                # further streams may follow, as in "cat a.gz b.gz"
+                data = unpacker.unused_data
+                unpacker, fed = decompressor(kind), False
+            #:
+        #:
+        if fed:
+            raise EOFError("Compressed input ended before the end-of-stream marker was reached")
+        #:
+    #:
+
+    def more(self):
+        return not self.eof
+    #:
+
+    def fill(self):
+        # append the lines of the next block to the unread lines
+        while not self.eof:
+            block = self.blocks.get()
+            if isinstance(block, Exception):
+                self.eof = True
+                raise block
+            #:
+            if block:
+                # break after a line end; the rest waits for the next block
+                data = self.rest + block
+                cut = max(data.rfind(b"\n"), data.rfind(b"\r")) + 1
+                data, self.rest = data[:cut], data[cut:]
+            else:
+                self.eof = True
+                data, self.rest = self.rest, b""
+            #:
+            if self.add_lines(self.decode(data)):
+                return
+            #:
+        #:
+    #:
+#:
+
+def open_tokenizer(filename):
+    """ MmapTokenizer for a plain file, StreamTokenizer for a compressed one """
+    with open(filename, "rb") as fh:
+        head = fh.read(8)
+    #:
+    if compression(head) is None:
+        return MmapTokenizer(filename)
+    #:
+    return StreamTokenizer(open(filename, "rb"))
+#:
+
+# Field handlers are called as handler(qif, record, value) where value is
+# the line with its field code removed.
+
+def _text(attr):
+    def handler(qif, record, value):
+        setattr(record, attr, value)
+    #:
+    return handler
+#:
+
+def _symbol(attr):
+    # values repeated across many records share one string
+    def handler(qif, record, value):
+        setattr(record, attr, sys.intern(value))
+    #:
+    return handler
+#:
+
+def _flag(attr):
+    def handler(qif, record, value):
+        setattr(record, attr, True)
+    #:
+    return handler
+#:
+
+def _decimal(attr):
+    def handler(qif, record, value):
+        setattr(record, attr, qif.parseDecimal(value))
+    #:
+    return handler
+#:
+
+def _date(attr):
+    def handler(qif, record, value):
+        setattr(record, attr, qif.parseDate(value))
+    #:
+    return handler
+#:
+
+def _split(field, decode=None):
+    def handler(qif, record, value):
+        record.addSplit(field, decode(qif, value) if decode else value)
+    #:
+    return handler
+#:
+
+def _line(field, decode=None):
+    def handler(qif, record, value):
+        record.addLine(field, decode(qif, value) if decode else value)
+    #:
+    return handler
+#:
+
+def _address(qif, transaction, value):
+    if transaction.address:
+        transaction.address.append(value)
+    else:
+        transaction.address = [value]
+    #:
+#:
+
+def _category(qif, transaction, value):
+    s = value.replace("|", "")  # garbage character
+    transaction.category = sys.intern(s.split("/")[0])
+    if transaction.category != s:
+        transaction.tag = sys.intern(s.split("/",1)[1])
+    #:
+#:
+
+def _split_category(qif, transaction, value):
+    category = sys.intern(value.split("/")[0])
+    transaction.addSplit("category", category)
+    if category != value:
+        tag = sys.intern(value.split("/",1)[1])
+        transaction.addSplit("tag", tag)
+    #:
+#:
+
+def _amount(qif, transaction, value):
+    if transaction.qtype == "Invst":
+        transaction.transferAmount = qif.parseDecimal(value)
+    else:
+        transaction.addSplit("amount", qif.parseDecimal(value))
+    #:
+#:
+
+# Headers process_section() does not parse as transaction sections.
+
+_RECORD_SECTIONS = ("!Type:Cat", "!Type:Tag", "!Account", "!Type:Prices", "!Type:Template",
+                    "!Type:Memorized", "!Type:Security", "!Type:InvItem")
+
+def _parse_part(cls, filename, encoding, start, end, qtype, at_header, account):
+    """ pickled Qif.capture() of bytes start:end of a transaction section
+
+    Runs in a worker process.  The part starts with the section header
+    when at_header is set, otherwise with a record.  An extra last item
+    is True when the parse left record mode before the end of the part
+    (after an empty record) as the rest of the section must then be
+    parsed the same way.
+    """
+    qif = cls.__new__(cls)
+    qif.reset(MmapTokenizer(filename, encoding, start, end))
+    if account is not None:
+        qif.lastAccount = Account()
+        qif.lastAccount.qname = account
+    #:
+    stopped = []
+
+    def records():
+        if at_header:
+            qif.tokens.getline()
+        #:
+        yield from qif.process_section_transaction(qtype)
+        stopped.append(bool(qif.tokens.line))
+        yield from qif.parse_serial()
+    #:
+
+    result = qif.capture(records()) + (bool(stopped and stopped[0]),)
+    return pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+#:
+
+# Parse caches start with CACHE_MAGIC and a line of JSON, the stamp of the
+# parser and of the QIF file they were made from; only then comes the
+# pickle, which is not loaded from a file without that header or with a
+# stale stamp.  Bump CACHE_VERSION when the snapshot layout changes; any
+# edit to this file also makes existing snapshots stale.
+
+CACHE_MAGIC = b"qifparser snapshot\n"
+CACHE_VERSION = 2
+
+def _unpickle(load, source):
+    # unpickling records builds many containers that the collector would
+    # otherwise rescan repeatedly
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return load(source)
+    finally:
+        if enabled:
+            gc.enable()
+        #:
+    #:
+#:
+
+def file_digest(filename):
+    digest = hashlib.blake2b()
+    with open(filename, "rb") as fh:
+        for block in iter(functools.partial(fh.read, 1 << 20), b""):
+            digest.update(block)
+        #:
+    #:
+    return digest.hexdigest()
+#:
+
+def handler_stamp(handler):
+    # a field handler by its name, the digest of the file defining it and
+    # the plain values it closes over, such as the attribute it sets
+    name = getattr(handler, "__qualname__", type(handler).__qualname__)
+    path = getattr(sys.modules.get(getattr(handler, "__module__", None)), "__file__", None)
+    values = [cell.cell_contents for cell in getattr(handler, "__closure__", None) or ()]
+    values = [value if isinstance(value, (str, int, float)) else getattr(value, "__qualname__", type(value).__qualname__)
+              for value in values]
+    return f"{name} {file_digest(path) if path else None} {values}"
+#:
+
+def clear_cache(cache):
+    """ remove the parse cache file `cache`, False if there was none """
+    try:
+        os.remove(cache)
+    except FileNotFoundError:
+        return False
+    #:
+    return True
+#:
+
+class Qif(object):
+
+    # entries kept by each of the date and decimal caches
+    cache_size = 1 << 16
+
+    # no restriction on what is parsed (see __init__)
+    selective = False
+    selected_accounts = None
+    selected_sections = None
+
+    # bytes of transactions given to a worker at a time when parsing in
+    # parallel; sections under a sixteenth of that are parsed in the
+    # calling process
+    part_size = 1 << 20
+
+    # Field code -> handler for each kind of record.  Codes are one
+    # character, except for the two character "X?" codes.  Use
+    # register_field() to add handlers.
+
+    category_fields = {
+        "B": _decimal("budget"),
+        "D": _text("description"),
+        "E": _text("e"),
+        "I": _flag("income"),
+        "N": _text("qname"),
+        "R": _text("taxSchedule"),
+        "T": _flag("taxRelated"),
+        }
+
+    security_fields = {
+        "G": _text("g"),
+        "N": _text("qname"),
+        "S": _text("symbol"),
+        "T": _text("type"),
+        }
+
+    account_fields = {
+        "D": _text("description"),
+        "L": _text("l"),
+        "N": _text("qname"),
+        "R": _text("r"),
+        "T": _text("type"),
+        }
+
+    transaction_fields = {
+        "A": _address,
+        "C": _symbol("cleared"),
+        "D": _date("date"),
+        "E": _split("memo"),
+        "I": _decimal("price"),
+        "K": _text("k"),
+        "L": _category,
+        "M": _text("memo"),
+        "N": _symbol("action"),
+        "O": _decimal("commission"),
+        "P": _symbol("payee"),
+        "Q": _decimal("quantity"),
+        "S": _split_category,
+        "T": _decimal("tAmount"),
+        "U": _decimal("uAmount"),
+        "Y": _symbol("security"),
+        "XI": _text("transactionType"),
+        "XE": _text("dueDate"),
+        "XF": _line("taxable"),
+        "XN": _line("category"),
+        "XP": _text("lineItemP"),
+        "XR": _text("taxRate"),
+        "XS": _line("description"),
+        "XT": _text("taxAmount"),
+        "X#": _line("quantity", lambda qif, value: qif.parseDecimal(value)),
+        "X$": _line("price", lambda qif, value: qif.parseDecimal(value)),
+        "$": _amount,
+        }
+
+    @classmethod
+    def register_field(cls, kind, code, handler):
+        """ parse field `code` of `kind` records with handler(qif, record, value)
+
+        kind is "category", "security", "account" or "transaction"; the
+        handler can only set the fields listed in the record's __slots__.
+        Registering on a subclass leaves the parent's table unchanged.
+        """
+        if not (len(code) == 1 and code != "X" or len(code) == 2 and code[0] == "X"):
+            raise ValueError(f"Bad field code: {code}")
+        #:
+        name = f"{kind}_fields"
+        fields = dict(getattr(cls, name))
+        fields[code] = handler
+        setattr(cls, name, fields)
+    #:
+
+    def __init__(self, filename=None, stream=False, cache=None, jobs=None,
+                 accounts=None, sections=None, index=None, messages=None):
+        """ parse a QIF file (or stdin)
+
+        gzip, bz2 and xz compressed input is decompressed as it is read.
+
+        By default the whole file is read, every transaction is attached to
+        its account and the quotes of the price history are kept in
+        self.prices.  With stream=True parsing only happens as the caller
+        iterates over iter_records(), and transactions are not retained.
+
+        cache names a file to keep the parsed records in, none by default.
+        When it holds a snapshot of the same file made by this parser, with
+        the same register_field() handlers, the records are loaded from it
+        instead of parsing; otherwise it is rewritten once iter_records()
+        has been consumed.  Only name a file that nobody else can write:
+        the snapshot is a pickle.  Messages written while parsing
+        are not repeated when the snapshot is used.
+
+        jobs > 1 parses the transaction sections of a file in that many
+        worker processes (0: one per CPU).  Records and messages come out
+        exactly as from a serial parse.
+
+        accounts and sections restrict parsing to the transactions of the
+        named accounts and to the sections with the given headers (such as
+        "!Type:Cat" or "!Type:Invst"); "!Account" sections are always read.
+        The sections of a file are located through an index of their byte
+        ranges (see section_index()), kept in the file named by index if
+        given, so that everything else is skipped unread.  A restricted
+        parse neither reads nor writes the cache and does not use jobs.
+
+        Messages about the input are written to messages, a text file,
+        sys.stderr by default.
+        """
+
+        self.filename = filename
+        self.messages = messages
+        self.selected_accounts = None if accounts is None else set(accounts)
+        self.selected_sections = None if sections is None else set(sections)
+        self.selective = accounts is not None or sections is not None
+
+        self.cache = cache if filename and not self.selective else None
+        self.index = index if filename and self.selective else None
+        self.stamp = self.cache_stamp(filename) if self.cache or self.index else None
+        self.snapshot = None
+        if self.cache:
+            self.snapshot = self.load_stamped(self.cache, "parse cache")
+        #:
+
+        if self.snapshot is not None:
+            tokens = None
+        elif filename:
+            tokens = open_tokenizer(filename)
+        elif hasattr(sys.stdin, "buffer"):
+            tokens = StreamTokenizer(sys.stdin.buffer, sys.stdin.encoding)
+        else:
+            tokens = TextTokenizer(sys.stdin)
+        #:
+        self.jobs = os.cpu_count() if jobs == 0 else jobs
+        self.reset(tokens, messages)
+
+        if not stream:
+            for record in self.iter_records():
+                if isinstance(record, Transaction):
+                    record.account.transactions.append(record)
+                elif isinstance(record, Price):
+                    self.prices.append(record)
+                #:
+            #:
+        #:
+    #:
+
+    def reset(self, tokens, messages=None):
+        # parser state, also used to set up the parser of a worker process
+        self.tokens = tokens
+        self.messages = messages
+        self.consumed = False
+        self.lastAccount = None
+        self.accounts = {}
+        self.categories = {}
+        self.securities = {}
+        self.prices = []
+
+        self.date_format = 0
+        self.date_cache = functools.lru_cache(self.cache_size)(self.decodeDate)
+        self.decimal_cache = functools.lru_cache(self.cache_size)(self.decodeDecimal)
+    #:
+
+    def iter_records(self):
+        """ yield categories, securities, accounts, transactions and prices as parsed
+
+        Categories, securities and accounts are yielded the first time their
+        name is seen; transactions are yielded with .account already set.
+        The input can only be consumed once; self.consumed is then true.
+        """
+        self.consumed = True
+        if self.snapshot is not None:
+            yield from self.replay_cache()
+            return
+        #:
+        if self.selective and isinstance(self.tokens, MmapTokenizer):
+            records = self.parse_selected()
+        elif self.jobs and self.jobs > 1 and isinstance(self.tokens, MmapTokenizer):
+            records = self.parse_parallel()
+        else:
+            records = self.parse_serial()
+        #:
+        if not self.cache:
+            yield from records
+            return
+        #:
+        saved = []
+        for record in records:
+            saved.append(record)
+            yield record
+        #:
+        self.save_stamped(self.cache, "parse cache", saved)
+    #:
+
+    def parse_serial(self):
+        while self.tokens.line:
+            yield from self.process_section()
+        #:
+    #:
+
+    def parse_selected(self):
+        """ parse_serial() of only the selected sections, found by seeking """
+        index = self.section_index()
+        if index is None:
+            yield from self.parse_serial()
+            return
+        #:
+        tokens = self.tokens
+        for header, start, end, account in index:
+            if self.selected(header, account):
+                tokens.seek(start, end)
+                yield from self.parse_serial()
+            #:
+        #:
+        tokens.seek(tokens.size)
+    #:
+
+    def selected(self, header, account):
+        """ whether a section is to be parsed (see __init__) """
+        if header == "!Account":
+            return True
+        #:
+        if self.selected_sections is not None and header not in self.selected_sections:
+            return False
+        #:
+        if self.selected_accounts is not None and header not in _RECORD_SECTIONS:
+            return account in self.selected_accounts
+        #:
+        return True
+    #:
+
+    def section_index(self):
+        """ [(header, start, end, account)] for every section of the file
+
+        start:end is the byte range of the section, header line included,
+        and account the name of the account a transaction section belongs
+        to (None if there is none).  Read from self.index when that was
+        saved for this file, otherwise built by reading only the "!Account"
+        sections and saved there.  None when the section boundaries cannot
+        be found without decoding the whole file.
+        """
+        if self.index:
+            index = self.load_stamped(self.index, "section index")
+            if index is not None:
+                return index
+            #:
+        #:
+
+        tokens = self.tokens
+        offsets = tokens.section_offsets()
+        if offsets is None:
+            return None
+        #:
+        # the accounts are read by a parser of their own, messages dropped
+        qif = type(self).__new__(type(self))
+        qif.reset(tokens)
+        index = []
+        for start, end in zip(offsets, offsets[1:] + [tokens.size]):
+            header = tokens.header(start, end)
+            index.append((header, start, end, qif.lastAccount and qif.lastAccount.qname))
+            if header == "!Account":
+                tokens.seek(start, end)
+                qif.capture(qif.parse_serial())
+            #:
+        #:
+        tokens.seek(0)
+
+        if self.index:
+            self.save_stamped(self.index, "section index", index)
+        #:
+        return index
+    #:
+
+    def parse_parallel(self):
+        """ parse_serial() with the transaction sections parsed by a pool
+
+        Section boundaries are found on the raw bytes.  Everything but the
+        transaction sections is parsed here, in file order, which settles
+        the account each transaction section belongs to; transaction
+        sections are cut at "^" lines into parts of about part_size bytes
+        and handed to the workers.  The messages of each part are
+        kept with the record it preceded and replayed in order.
+        """
+        tokens = self.tokens
+        offsets = tokens.section_offsets()
+        if offsets is None:
+            yield from self.parse_serial()
+            return
+        #:
+        bounds = [0] + offsets + [tokens.size]
+        pool = concurrent.futures.ProcessPoolExecutor(self.jobs)
+        try:
+            # (start, end of section, result or future, account)
+            parts = []
+            for i, (start, end) in enumerate(zip(bounds, bounds[1:])):
+                if start == end:
+                    continue
+                #:
+                header = tokens.header(start, end)
+                if i == 0 or header in _RECORD_SECTIONS or end - start < self.part_size // 16:
+                    tokens.seek(start, end)
+                    result = self.capture(self.parse_serial())
+                    parts.append((start, end, result, None))
+                    if result[3]:
+                        break
+                    #:
+                    continue
+                #:
+                at_header = True
+                while start < end:
+                    cut = tokens.record_end(min(start + self.part_size, end), end)
+                    future = pool.submit(_parse_part, type(self), self.filename, tokens.encoding,
+                                         start, cut, header[6:], at_header,
+                                         getattr(self.lastAccount, "qname", None))
+                    parts.append((start, end, future, self.lastAccount))
+                    start = cut
+                    at_header = False
+                #:
+            #:
+
+            redo = 0        # end of a section that left record mode in a worker
+            done = 0        # end of a section already finished here
+            for start, end, result, account in parts:
+                if start < done:
+                    result.cancel()
+                    continue
+                elif start < redo:
+                    # the rest of the section is parsed the way the
+                    # serial parser does after an empty record
+                    result.cancel()
+                    tokens.seek(start, end)
+                    result = self.capture(self.parse_serial())
+                    done = end
+                elif isinstance(result, concurrent.futures.Future):
+                    result = _unpickle(pickle.loads, result.result())
+                    if result[4]:
+                        redo = end
+                    #:
+                #:
+                records, messages, tail, error = result[:4]
+                for i, record in enumerate(records):
+                    if i in messages:
+                        self.warn(messages[i])
+                    #:
+                    if account:
+                        record.account = account
+                    #:
+                    yield record
+                #:
+                self.warn(tail)
+                if error:
+                    raise error
+                #:
+            #:
+        finally:
+            pool.shutdown(cancel_futures=True)
+        #:
+        tokens.seek(tokens.size)
+    #:
+
+    def warn(self, text):
+        """ write a parser message to self.messages (sys.stderr if None) """
+        (self.messages or sys.stderr).write(text)
+    #:
+
+    def capture(self, records):
+        """ (records, {index: text}, tail text, exception) after running records
+
+        text is the messages warn() wrote before the record with that
+        index, tail those written after the last one.  exception is what
+        stopped the parse early, None if nothing did.  Only this parser's
+        messages are captured, so parsers in other threads are unaffected.
+        """
+        messages_to = self.messages
+        self.messages = buffer = io.StringIO()
+        result = []
+        messages = {}
+        error = None
+        try:
+            for record in records:
+                if buffer.tell():
+                    messages[len(result)] = buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+                #:
+                result.append(record)
+            #:
+        except Exception as e:
+            error = e
+        finally:
+            self.messages = messages_to
+        #:
+        return result, messages, buffer.getvalue(), error
+    #:
+
+    def cache_stamp(self, filename):
+        # what a usable cache or index of filename must have been made
+        # from; the digest is only computed when the mtime does not settle it
+        stat = os.stat(filename)
+        return {"version": f"{CACHE_VERSION} {file_digest(__file__)} {type(self).__qualname__}",
+                "fields": self.field_overrides(),
+                "filename": filename,
+                "size": stat.st_size,
+                "mtime": stat.st_mtime_ns,
+                "digest": None}
+    #:
+
+    def field_overrides(self):
+        # the field handlers registered over the tables of this file, which
+        # its digest does not cover
+        overrides = []
+        for kind, base in FILE_FIELDS.items():
+            fields = getattr(self, f"{kind}_fields")
+            for code in sorted(fields):
+                if fields[code] is not base.get(code):
+                    overrides.append(f"{kind} {code} {handler_stamp(fields[code])}")
+                #:
+            #:
+        #:
+        return overrides
+    #:
+
+    def fresh(self, stamp):
+        """ whether a saved stamp was made from this file by this parser """
+        if (stamp["version"] != self.stamp["version"] or stamp["fields"] != self.stamp["fields"]
+            or stamp["size"] != self.stamp["size"]):
+            return False
+        #:
+        if stamp["mtime"] != self.stamp["mtime"]:
+            if self.stamp["digest"] is None:
+                self.stamp["digest"] = file_digest(self.stamp["filename"])
+            #:
+            return stamp["digest"] == self.stamp["digest"]
+        #:
+        return True
+    #:
+
+    def load_stamped(self, path, what):
+        """ what was saved in path for this file, None if missing or stale """
+        try:
+            with open(path, "rb") as fh:
+                if fh.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+                    raise ValueError("not a qifparser snapshot")
+                #:
+                if not self.fresh(json.loads(fh.readline())):
+                    return None
+                #:
+                return _unpickle(pickle.load, fh)
+            #:
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            self.warn("Ignoring %s %s: %s\n" % (what, path, e))
+            return None
+        #:
+    #:
+
+    def save_stamped(self, path, what, data):
+        # written to a temporary file first so that an interrupted run
+        # cannot leave a truncated file behind
+        if self.stamp["digest"] is None:
+            self.stamp["digest"] = file_digest(self.stamp["filename"])
+        #:
+        temp = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(temp, "wb") as fh:
+                fh.write(CACHE_MAGIC)
+                fh.write(json.dumps(self.stamp).encode() + b"\n")
+                pickle.dump(data, fh, pickle.HIGHEST_PROTOCOL)
+            #:
+            os.replace(temp, path)
+        except OSError as e:
+            self.warn("Cannot write %s %s: %s\n" % (what, path, e))
+            if os.path.exists(temp):
+                os.remove(temp)
+            #:
+        #:
+    #:
+
+    def replay_cache(self):
+        # yield the snapshot as process_section() would have
+        records = self.snapshot
+        self.snapshot = ()
+        for record in records:
+            kind = type(record)
+            if kind is Account:
+                # transactions were saved with their account when not streaming
+                record.transactions = []
+                self.accounts[record.qname] = record
+                self.lastAccount = record
+            elif kind is Category:
+                self.categories[record.qname] = record
+            elif kind is Security:
+                self.securities[record.qname] = record
+            #:
+            yield record
+        #:
+    #:
+
+
     def process_section(self):
 
-        if not self.inputLine.startswith("!"):
-            sys.stderr.write("No header: %s\n" % self.inputLine)
-            self.getline()
+        if not self.tokens.line.startswith("!"):
+            self.warn("No header: %s\n" % self.tokens.line)
+            self.tokens.getline()
             return
         #:
         
-        #sys.stderr.write("Header: %s\n" % self.inputLine)
-        section = self.inputLine
-        self.getline()
+        #self.warn("Header: %s\n" % self.tokens.line)
+        section = self.tokens.line
+        self.tokens.getline()
+
+        if self.selective and not self.selected(section, self.lastAccount and self.lastAccount.qname):
+            self.process_section_ignored()
+            return
+        #:
         
         if section == "!Type:Cat":
-            self.process_section_cat()
+            yield from self.process_section_cat()
         elif section == "!Type:Tag":
             self.process_section_ignored()
         elif section == "!Account":
-            self.process_section_account()
+            yield from self.process_section_account()
         elif section == "!Type:Prices":
-            self.process_section_ignored()
+            yield from self.process_section_prices()
         elif section == "!Type:Template":
             self.process_section_ignored()
         elif section == "!Type:Memorized":
             self.process_section_ignored()
         elif section == "!Type:Security":
-            self.process_section_security()
+            yield from self.process_section_security()
         elif section == "!Type:InvItem":
             self.process_section_ignored()
         else:
-            self.process_section_transaction(section[6:])
+            yield from self.process_section_transaction(section[6:])
         #:
     #:
 
     def process_section_ignored(self):
-        #sys.stderr.write("Ignored: %s\n" % self.inputLine)
-        while self.inputLine and not self.inputLine.startswith("!"):
-            self.getline()
-        #:
+        #self.warn("Ignored: %s\n" % self.tokens.line)
+        self.tokens.skip_section()
     #:
 
     def process_section_cat(self):
-        chunk = self.getchunk()
+        fields = self.category_fields
+        chunk = self.tokens.getchunk()
         while chunk:
             category = Category()
             for thing in chunk:
-                if thing[0] == "B":
-                    category.budget = self.parseDecimal(thing[1:])
-                elif thing[0] == "D":
-                    category.description = thing[1:]
-                elif thing[0] == "E":
-                    category.e = thing[1:] 
-                elif thing[0] == "I":
-                    category.income = True 
-                elif thing[0] == "N":
-                    category.qname = thing[1:]
-                elif thing[0] == "R":
-                    category.taxSchedule = thing[1:]
-                elif thing[0] == "T":
-                    category.taxRelated = True 
+                code = thing[:2] if thing[0] == "X" else thing[0]
+                handler = fields.get(code)
+                if handler:
+                    handler(self, category, thing[len(code):])
                 else:
-                    sys.stderr.write("Unknown value for category: %s: %s\n" % (chunk[0], thing))
+                    self.warn("Unknown value for category: %s: %s\n" % (chunk[0], thing))
                 #:
             #:
             if not category.qname:
-                sys.stderr.write("No name for category: %s\n" % chunk[0])
+                self.warn("No name for category: %s\n" % chunk[0])
+                chunk = self.tokens.getchunk()
                 continue
             #:
             if category.qname not in self.categories:
                 self.categories[category.qname] = category
+                yield category
             #:
 
-            chunk = self.getchunk()
+            chunk = self.tokens.getchunk()
+        #:
+    #:
+
+    def process_section_prices(self):
+        # lines like "ACM",12.5," 1/ 2/98"
+        chunk = self.tokens.getchunk()
+        while chunk:
+            for thing in chunk:
+                values = next(csv.reader([thing]))
+                if len(values) < 3 or not values[0] or not values[1].strip() or not values[2].strip():
+                    self.warn("Bad price: %s\n" % thing)
+                    continue
+                #:
+                price = Price()
+                price.security = values[0]
+                price.price = self.parsePrice(values[1].strip())
+                price.date = self.parseDate(values[2].strip())
+                yield price
+            #:
+            chunk = self.tokens.getchunk()
         #:
     #:
 
     def process_section_security(self):
-        chunk = self.getchunk()
+        fields = self.security_fields
+        chunk = self.tokens.getchunk()
         while chunk:
             security = Security()
             for thing in chunk:
-                if thing[0] == "G":
-                    security.g = thing[1:]
-                elif thing[0] == "N":
-                    security.qname = thing[1:]
-                elif thing[0] == "S":
-                    security.symbol = thing[1:]
-                elif thing[0] == "T":
-                    security.type = thing[1:] 
+                code = thing[:2] if thing[0] == "X" else thing[0]
+                handler = fields.get(code)
+                if handler:
+                    handler(self, security, thing[len(code):])
                 else:
-                    sys.stderr.write("Unknown value for security: %s: %s\n" % (chunk[0], thing))
+                    self.warn("Unknown value for security: %s: %s\n" % (chunk[0], thing))
                 #:
             #:
             if not security.qname:
-                sys.stderr.write("No name for security: %s\n" % chunk[0])
+                self.warn("No name for security: %s\n" % chunk[0])
+                chunk = self.tokens.getchunk()
                 continue
             #:
             if security.qname not in self.securities:
                 self.securities[security.qname] = security
+                yield security
             #:
 
-            chunk = self.getchunk()
+            chunk = self.tokens.getchunk()
         #:
     #:
 
     def process_section_account(self):
         # contains one or more accounts
         
-        chunk = self.getchunk()
+        fields = self.account_fields
+        chunk = self.tokens.getchunk()
         while chunk:
-            #sys.stderr.write("Account: %s\n" % chunk[0])
+            #self.warn("Account: %s\n" % chunk[0])
             account = Account()
             for thing in chunk:
-                if thing[0] == "D":
-                    account.description = thing[1:]
-                elif thing[0] == "L":
-                    account.l = thing[1:]
-                elif thing[0] == "N":
-                    account.qname = thing[1:]
-                elif thing[0] == "R":
-                    account.r = thing[1:]
-                elif thing[0] == "T":
-                    account.type = thing[1:]
+                code = thing[:2] if thing[0] == "X" else thing[0]
+                handler = fields.get(code)
+                if handler:
+                    handler(self, account, thing[len(code):])
                 else:
-                    sys.stderr.write("Unknown value for Account: %s: %s\n" % (chunk[0], thing))
+                    self.warn("Unknown value for Account: %s: %s\n" % (chunk[0], thing))
                 #:
             #:
             if not account.qname:
-                sys.stderr.write("No name for Account: %s\n" % chunk[0])
+                self.warn("No name for Account: %s\n" % chunk[0])
+                chunk = self.tokens.getchunk()
                 continue
             #:
             if account.qname not in self.accounts:
                 self.accounts[account.qname] = account
+                yield account
             #:
 
             self.lastAccount = self.accounts[account.qname]
-            chunk = self.getchunk()
+            chunk = self.tokens.getchunk()
         #:
     #:
 
     def process_section_transaction(self, qtype):
         # contains one or more transactions for the previous account
             
-        chunk = self.getchunk()
+        fields = self.transaction_fields
+        chunk = self.tokens.getchunk()
         while chunk:
             transaction = Transaction()
             transaction.qtype = qtype
             for thing in chunk:
-                if thing[0] == "A":
-                    transaction.address.append(thing[1:])
-                elif thing[0] == "C":
-                    transaction.cleared = thing[1:]
-                elif thing[0] == "D":
-                    transaction.date = self.parseDate(thing[1:])
-                elif thing[0] == "E":
-                    transaction.addSplit("memo", thing[1:])
-                elif thing[0] == "I":
-                    transaction.price = self.parseDecimal(thing[1:])
-                elif thing[0] == "K":
-                    transaction.k = thing[1:]
-                elif thing[0] == "L":
-                    s = thing[1:]
-                    s = s.replace("|", "")  # garbage character
-                    transaction.category = s.split("/")[0]
-                    if transaction.category != s:
-                        transaction.tag = s.split("/",1)[1]
-                    #:
-                elif thing[0] == "M":
-                    transaction.memo = thing[1:]
-                elif thing[0] == "N":
-                    transaction.action = thing[1:]
-                elif thing[0] == "O":
-                    transaction.commission = self.parseDecimal(thing[1:])
-                elif thing[0] == "P":
-                    transaction.payee = thing[1:]
-                elif thing[0] == "Q":
-                    transaction.quantity = self.parseDecimal(thing[1:])
-                elif thing[0] == "S":
-                    s = thing[1:]
-                    category = s.split("/")[0]
-                    transaction.addSplit("category", category)
-                    if category != s:
-                        tag = s.split("/",1)[1]
-                        transaction.addSplit("tag", tag)
-                    #:
-                elif thing[0] == "T":
-                    transaction.tAmount = self.parseDecimal(thing[1:])
-                elif thing[0] == "U":
-                    transaction.uAmount = self.parseDecimal(thing[1:])
-                elif thing[0] == "Y":
-                    transaction.security = thing[1:]
-                elif thing[0:2] == "XI":
-                    transaction.transactionType = thing[2:]
-                elif thing[0:2] == "XE":
-                    transaction.dueDate = thing[2:]
-                elif thing[0:2] == "XF":
-                    transaction.addLine("taxable", thing[2:])
-                elif thing[0:2] == "XN":
-                    transaction.addLine("category", thing[2:])
-                elif thing[0:2] == "XP":
-                    transaction.lineItemP = thing[2:]
-                elif thing[0:2] == "XR":
-                    transaction.taxRate = thing[2:]
-                elif thing[0:2] == "XS":
-                    transaction.addLine("description", thing[2:])
-                elif thing[0:2] == "XT":
-                    transaction.taxAmount = thing[2:]
-                elif thing[0:2] == "X#":
-                    transaction.addLine("quantity", self.parseDecimal(thing[2:]))
-                elif thing[0:2] == "X$":
-                    transaction.addLine("price", self.parseDecimal(thing[2:]))
-                elif thing[0] == "$":
-                    if qtype == "Invst":
-                        transaction.transferAmount = self.parseDecimal(thing[1:])
-                    else:
-                        transaction.addSplit("amount", self.parseDecimal(thing[1:]))
-                    #:
+                code = thing[:2] if thing[0] == "X" else thing[0]
+                handler = fields.get(code)
+                if handler:
+                    handler(self, transaction, thing[len(code):])
                 else:
-                    sys.stderr.write("Unknown value for transaction: %s: %s\n" % (self.lastAccount.qname, thing))
+                    self.warn("Unknown value for transaction: %s: %s\n" % (self.lastAccount.qname, thing))
                 #:
             #:
 
             if self.lastAccount:
                 transaction.account = self.lastAccount
-                self.lastAccount.transactions.append(transaction)
+                yield transaction
             else:
-                sys.stderr.write("No last account: %s\n" % qtype)
+                self.warn("No last account: %s\n" % qtype)
             #:
             
-            chunk = self.getchunk()
+            chunk = self.tokens.getchunk()
         #:
     #:
 
 
     def parseDate(self, qdate):
+        # repeated dates return the datetime already built for them
+        return self.date_cache(qdate)
+    #:
+
+    def parseDecimal(self, s):
+        # repeated amounts return the Decimal already built for them;
+        # bad values are not cached so that every occurrence is reported
+        try:
+            d = self.decimal_cache(s)
+        except decimal.InvalidOperation:
+            self.warn("Unknown decimal value: %s\n" % s)
+            d = decimal.Decimal(0)
+        #:
+        return d
+    #:
+
+    def parsePrice(self, s):
+        # quotes may be fractions like "12 3/8"
+        m = _FRACTION.fullmatch(s)
+        if m:
+            whole, numerator, denominator = m.groups()
+            if int(denominator):
+                return decimal.Decimal(whole or 0) + decimal.Decimal(numerator) / decimal.Decimal(denominator)
+            #:
+        #:
+        return self.parseDecimal(s)
+    #:
+
+    def cache_info(self):
+        """ hit/miss counters of the date and decimal caches """
+        return {"date": self.date_cache.cache_info(),
+                "decimal": self.decimal_cache.cache_info()}
+    #:
+
+    def decodeDate(self, qdate):
+        # try the format the previous date had first
+        for i in [self.date_format] + list(range(len(_DATE_FORMATS))):
+            m = _DATE_FORMATS[i][0].fullmatch(qdate)
+            if m:
+                self.date_format = i
+                century = _DATE_FORMATS[i][1]
+                return datetime.datetime(century + int(m.group(3)), int(m.group(1)), int(m.group(2)))
+            #:
+        #:
+        return self.decodeDateSlow(qdate)
+    #:
+
+    def decodeDateSlow(self, qdate):
         """ convert from QIF time format to ISO date string
 
         QIF is like "7/ 9/98"  "9/ 7/99" or "10/10/99" or "10/10'01" for y2k
@@ -382,18 +1598,16 @@ class Qif(object):
         return datetime.datetime.strptime(iso_date, '%Y-%m-%d')
     #:                
 
-    def parseDecimal(self, s):
-        try:
-            d = decimal.Decimal(s.replace(",", ""))
-        except:
-            sys.stderr.write("Unknown decimal value: %s\n" % s)
-            d = decimal.Decimal(0)
-        #:
-        return d
+    def decodeDecimal(self, s):
+        return decimal.Decimal(s.replace(",", ""))
     #:
     
 #:
 
+# the field tables as defined above, covered by the digest of this file;
+# register_field() replaces a table rather than change it
+FILE_FIELDS = {kind: getattr(Qif, f"{kind}_fields") for kind in ("category", "security", "account", "transaction")}
+
 if __name__ == "__main__":
 
     qif = Qif()